@@ -1,4 +1,5 @@
 import os
+import quopri
 import logging
 import imaplib
 import email, warnings
@@ -17,7 +18,6 @@ from .helpers import (
     get_name_template,
     write_contents,
     make_archive,
-    decode_quoted_printable,
 )
 from src import app
 from .exceptions import *
@@ -178,6 +178,12 @@ def get_file_name(part):
     return filename
 
 
+def decode_quoted_printable(contents) -> str:
+    text = quopri.decodestring(bytes(contents, "utf-8"))
+    text = text.decode("utf-8")
+    return text
+
+
 def get_Transfer_Encoding(part):
     data = [x for x in part.items() if x[0] == "Content-Transfer-Encoding"]
     return data[0][1] if data else ""
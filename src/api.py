@@ -5,11 +5,15 @@ from src.emessages import (
     fetch_messages as f_messages,
     fetch_message as f_message,
     fetch_attachments as f_attachments,
+    get_results as f_results,
+    get_bodies as f_bodies,
+    fetch_batch as f_batch,
 )
 
 from flask_api import status
 from src.helpers import serialize
 from src.result import Result
+from src.imap_pool import pool
 from src import app
 from src.exceptions import *
 
@@ -29,9 +33,7 @@ def fetch_messages(**param):
             id = bytes(str(id), "utf-8")
             results = f_message(id, param["path"])
         else:
-            search_text = param.get("inn") if param.get("inn") else ""
-            search_text += "," if param.get("inn") and param.get("ogrn") else ""
-            search_text += param.get("ogrn") if param.get("ogrn") else ""
+            search_text = get_search_text(**param)
             results = f_messages(search_text, param["path"])
         return results
     except ConnectionErrorException as ex:
@@ -40,6 +42,45 @@ def fetch_messages(**param):
         return Result(error_message=f"{ex}")
 
 
+def get_search_text(**param) -> str:
+    """Критерий поиска: ИНН и (или) ОГРН через запятую"""
+    search_text = param.get("inn") if param.get("inn") else ""
+    search_text += "," if param.get("inn") and param.get("ogrn") else ""
+    search_text += param.get("ogrn") if param.get("ogrn") else ""
+    return search_text
+
+
+def fetch_results(handles: list, criteria: str):
+    """Получить письма страницы по ссылкам курсора"""
+    try:
+        return f_results(handles, criteria)
+    except Exception as ex:
+        return [Result(error_message=f"{ex}")]
+
+
+def fetch_bodies(results: list, criteria: str = ""):
+    """Добавить полный текст писем (fields=body)"""
+    try:
+        return f_bodies(results, criteria)
+    except Exception as ex:
+        logger.error(f"{ex}")
+        return results
+
+
+def fetch_batch(tokens: list, path: set):
+    """Пакетный поиск писем по списку ИНН/ОГРН: ({ИНН/ОГРН: [письма]}, [ошибки])"""
+    try:
+        return f_batch(tokens, path)
+    except Exception as ex:
+        logger.error(f"{ex}")
+        return {}, [Result(error_message=f"{ex}")]
+
+
+def connection_pools() -> list:
+    """Пулы IMAP-соединений, занятые запросами (для фоновой выборки)"""
+    return [pool]
+
+
 def fetch_attachments(**param):
     """Получить вложения письма по идентификатору письма id
     если задан иден.файла "attach" не равный "0", то возвращается
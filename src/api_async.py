@@ -0,0 +1,79 @@
+# API при использовании асинхронного модуля aioimaplib (IMAP_BACKEND: async)
+import logging
+from .emessages_async import (
+    run,
+    fetch_messages_async,
+    fetch_message_async,
+    fetch_attachments_async,
+    get_results_async,
+    get_pool,
+)
+from src import api
+from src.result import Result
+from src.imap_pool import pool
+from .exceptions import *
+
+logger = logging.getLogger(__name__)
+
+# общие с синхронным API: полный текст писем и пакетный поиск выполняются
+# синхронным модулем через пул соединений imaplib
+get_search_text = api.get_search_text
+fetch_bodies = api.fetch_bodies
+fetch_batch = api.fetch_batch
+
+
+def fetch_messages(**param):
+    """Получить список писем по ИНН или ОГРН
+    ИНН или ОГРН ищутся в теле и заголовке писем
+    если задан идентификатор id возвращается письмо соответстующее
+    этому идентификатору
+    """
+    try:
+        id = param.get("id")
+        if id:
+            id = bytes(str(id), "utf-8")
+            results = run(fetch_message_async(id, param["path"]))
+        else:
+            search_text = get_search_text(**param)
+            results = run(fetch_messages_async(search_text, param["path"]))
+        return results
+    except ConnectionErrorException as ex:
+        return Result(error_message=f"{ex}")
+    except Exception as ex:
+        return Result(error_message=f"{ex}")
+
+
+def fetch_results(handles: list, criteria: str):
+    """Получить письма страницы по ссылкам курсора"""
+    try:
+        return run(get_results_async(handles, criteria))
+    except Exception as ex:
+        return [Result(error_message=f"{ex}")]
+
+
+def connection_pools() -> list:
+    """Пулы IMAP-соединений, занятые запросами (для фоновой выборки):
+    асинхронный пул и пул imaplib (полный текст писем, пакетный поиск)"""
+    return [get_pool(), pool]
+
+
+def fetch_attachments(**param):
+    """Получить вложения письма по идентификатору письма id
+    если задан иден.файла "attach" не равный "0", то возвращается
+    файл соответствующий этому идентификатору
+    """
+    try:
+        id = param.get("id")
+        if id:
+            id = bytes(str(id), "utf-8")
+            attachments = param.get("attach")
+            if attachments:
+                return run(fetch_attachments_async(id, param["path"], attachments))
+    except ConnectionErrorException as ex:
+        return Result(error_message=f"{ex}")
+    except Exception as ex:
+        return Result(error_message=f"{ex}")
+
+
+if __name__ == "__main__":
+    pass
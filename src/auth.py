@@ -34,6 +34,7 @@ def verify_token(token):
     result = {
         "ogrn": data.get("ogrn"),
         "inn": data.get("inn"),
+        "batch": data.get("batch"),
         "token": token,
         "error": error_message,
     }
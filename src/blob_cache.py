@@ -0,0 +1,135 @@
+"""Дисковый кеш вложений с адресацией по содержимому.
+Файл хранится как objects/<hh>/<sha256>/<имя файла>, ссылка на него
+по ключу (папка, UIDVALIDITY, UID, секция) - refs/<sha1 ключа>.
+Суммарный размер ограничен BLOB_CACHE.MAX_BYTES, при превышении
+удаляются давно не запрашивавшиеся файлы. Файлы больше MAX_BYTES
+не кешируются"""
+import os
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Optional
+from src import app
+from src.helpers import safe_file_name
+
+logger = logging.getLogger(__name__)
+
+_evict_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return bool(app.config.get("BLOB_CACHE") and app.config.BLOB_CACHE.ENABLED)
+
+
+def _root() -> Path:
+    return Path(
+        Path(__file__).resolve().parent.parent, app.config.BLOB_CACHE.PATH
+    ).resolve()
+
+
+def _ref_path(key: tuple) -> Path:
+    digest = hashlib.sha1("\n".join(str(x) for x in key).encode("utf-8")).hexdigest()
+    return Path(_root(), "refs", digest[:2], digest)
+
+
+def contains(filename) -> bool:
+    """Файл принадлежит кешу (его нельзя удалять после отправки)"""
+    if not enabled():
+        return False
+    try:
+        Path(filename).resolve().relative_to(_root())
+        return True
+    except ValueError:
+        return False
+
+
+def get(key: tuple) -> Optional[Path]:
+    """Путь к закешированному файлу или None"""
+    ref = _ref_path(key)
+    try:
+        filename = Path(_root(), "objects", ref.read_text(encoding="utf-8"))
+        os.utime(filename)  # время последнего обращения для вытеснения
+    except (OSError, ValueError):
+        return None
+    return filename
+
+
+def staging_path() -> Path:
+    """Временный файл для загрузки (в той же файловой системе, что и кеш)"""
+    path = Path(_root(), "tmp")
+    path.mkdir(parents=True, exist_ok=True)
+    return Path(path, f"{os.getpid()}-{threading.get_ident()}-{time.time_ns()}")
+
+
+def put(key: tuple, source: Path, name: str) -> Optional[Path]:
+    """Поместить загруженный файл source в кеш под именем name
+    (имя из заголовков письма, каталоги в нем отбрасываются).
+    Файл больше BLOB_CACHE.MAX_BYTES не кешируется: None, source остается"""
+    name = safe_file_name(name)
+    if not name:
+        raise ValueError("Пустое имя файла вложения")
+    if os.path.getsize(source) > app.config.BLOB_CACHE.MAX_BYTES:
+        return None
+    digest = hashlib.sha256()
+    with open(source, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+    relative = Path(digest[:2], digest, name)
+    filename = Path(_root(), "objects", relative)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    if filename.exists():
+        os.unlink(source)
+        os.utime(filename)
+    else:
+        os.replace(source, filename)
+
+    ref = _ref_path(key)
+    ref.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(ref.parent, f"{ref.name}.{os.getpid()}.{threading.get_ident()}")
+    tmp.write_text(relative.as_posix(), encoding="utf-8")
+    os.replace(tmp, ref)
+    evict(keep=filename.parent)
+    return filename
+
+
+def link(source: Path, target: Path):
+    """Копия закешированного файла (жесткая ссылка, если возможно)"""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def evict(keep: Path = None):
+    """Удалить давно не запрашивавшиеся файлы сверх MAX_BYTES, кроме keep
+    и файлов, запрошенных за последние MIN_AGE_SECONDS (их могут
+    отправлять сейчас). Ссылки на удаленные файлы отбрасываются
+    при следующем обращении"""
+    if not _evict_lock.acquire(blocking=False):
+        return
+    try:
+        objects = []
+        total = 0
+        for path in Path(_root(), "objects").glob("*/*"):
+            files = [x.stat() for x in path.iterdir() if x.is_file()]
+            size = sum(x.st_size for x in files)
+            used = max((x.st_mtime for x in files), default=0)
+            objects.append((used, size, path))
+            total += size
+        objects.sort(key=lambda x: x[0])
+        recent = time.time() - app.config.BLOB_CACHE.MIN_AGE_SECONDS
+        for used, size, path in objects:
+            if total <= app.config.BLOB_CACHE.MAX_BYTES or used > recent:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+    except OSError as ex:
+        logger.warning(f"{ex}")
+    finally:
+        _evict_lock.release()
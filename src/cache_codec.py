@@ -0,0 +1,56 @@
+"""Компактная версионированная сериализация значений кеша.
+Вместо pickle значения хранятся как JSON (сжатый zlib для длинных записей),
+ключи - пространство имен с версией схемы и хешем аргументов.
+При изменении формата увеличивается SCHEMA_VERSION: прежние записи
+перестают читаться и истекают по времени жизни"""
+import json
+import zlib
+import hashlib
+from src.result import Result
+from src.exceptions import CachedFailure
+
+SCHEMA_VERSION = 2
+COMPRESS_MIN_SIZE = 1024
+
+_RAW = b"j"
+_ZLIB = b"z"
+
+
+def make_key(name: str, args: tuple) -> str:
+    """Ключ вида imap:v<SCHEMA_VERSION>:<функция>:<sha1 аргументов>"""
+    normalized = [x.decode("utf-8") if isinstance(x, bytes) else x for x in args]
+    digest = hashlib.sha1(
+        json.dumps(normalized, ensure_ascii=False, default=str).encode("utf-8")
+    ).hexdigest()
+    return f"imap:v{SCHEMA_VERSION}:{name}:{digest}"
+
+
+def encode(value) -> bytes:
+    if isinstance(value, Result):
+        record = {"r": value.to_record()}
+    elif isinstance(value, CachedFailure):
+        record = {"f": f"{value}"}
+    else:
+        record = {"v": value}
+    data = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode(
+        "utf-8"
+    )
+    if len(data) >= COMPRESS_MIN_SIZE:
+        return _ZLIB + zlib.compress(data)
+    return _RAW + data
+
+
+def decode(data: bytes):
+    """Значение записи кеша; ValueError - запись другого формата"""
+    if data[:1] == _ZLIB:
+        data = zlib.decompress(data[1:])
+    elif data[:1] == _RAW:
+        data = data[1:]
+    else:
+        raise ValueError("неизвестный формат записи кеша")
+    record = json.loads(data)
+    if "r" in record:
+        return Result.from_record(record["r"])
+    if "f" in record:
+        return CachedFailure(record["f"])
+    return record["v"]
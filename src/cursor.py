@@ -0,0 +1,63 @@
+"""Курсоры постраничного вывода списка писем.
+Первый запрос сохраняет отсортированные ссылки на результаты (папка, UID)
+под случайным токеном, следующие страницы выбирают только свои письма
+из кеша без повторного поиска и сортировки"""
+import json
+import secrets
+import logging
+import redis
+from typing import Optional
+from src import app
+from src.redis_cache import redis_client, available, LocalCache
+
+logger = logging.getLogger(__name__)
+
+# курсоры воркера, пока Redis недоступен
+_local = LocalCache(maxsize=256, ttl=app.config.CURSOR.TTL_SECONDS)
+
+
+def _key(token: str) -> str:
+    return f"imap:cursor:{token}"
+
+
+def handles(results: list) -> list:
+    """Ссылки на результаты в порядке вывода"""
+    return [
+        {"error": result.error}
+        if result.error
+        else {"path": result.path, "id": result.id.decode()}
+        for result in results
+    ]
+
+
+def save(query: dict, criteria: str, items: list) -> str:
+    token = secrets.token_urlsafe(16)
+    data = {"query": query, "criteria": criteria, "handles": items}
+    _local.set(token, data)
+    if available():
+        try:
+            redis_client.set(
+                _key(token),
+                json.dumps(data, ensure_ascii=False),
+                ex=app.config.CURSOR.TTL_SECONDS,
+            )
+        except redis.RedisError as ex:
+            logger.warning(f"{ex}")
+    return token
+
+
+def load(token: str, query: dict) -> Optional[dict]:
+    """Данные курсора, если он не истек и выдан для того же запроса"""
+    if not token:
+        return None
+    found, data = _local.get(token)
+    if not found and available():
+        try:
+            value = redis_client.get(_key(token))
+        except redis.RedisError as ex:
+            logger.warning(f"{ex}")
+            value = None
+        data = json.loads(value) if value else None
+    if data and data["query"] == query:
+        return data
+    return None
@@ -1,129 +1,635 @@
-import imaplib
+import json
 import email
-import warnings
 import logging
+import shutil
 import datetime
-import re
 from pathlib import Path
 from email.header import decode_header
-from typing import Tuple, List, Any
-from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
+from email.parser import BytesHeaderParser
+from typing import List, Any
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from functools import lru_cache
 from .settings import *
-from .result import Result
+from .result import Result, NO_ATTACHMENTS
+from .matcher import Matcher
 from .helpers import (
     get_name_template,
     write_contents,
     make_archive,
-    decode_quoted_printable,
+    part_to_text,
+    decode_payload,
+    unique_name,
+    PayloadDecoder,
 )
 from src import app
-from src.redis_cache import cache
+from src.redis_cache import cache, LocalCache
+from src.imap_pool import pooled_connection, status as mailbox_status
+from src import (
+    uid_index,
+    mirror,
+    token_index,
+    search_cache,
+    blob_cache,
+    parse_pool,
+)
+from src.mime_scan import scan
+from src.imap_response import (
+    parse_fetch,
+    sequence_set,
+    batches,
+    body_parts,
+    part_filename,
+)
 from .exceptions import *
 
-warnings.filterwarnings("ignore", category=MarkupResemblesLocatorWarning)
 logger = logging.getLogger(__name__)
 
-connection_pool = ThreadPoolExecutor(max_workers=16)
+# заголовки, необходимые для списка писем
+LISTING_HEADERS = "HEADER.FIELDS (DATE SUBJECT RETURN-PATH)"
+LISTING_ITEMS = f"(UID BODYSTRUCTURE BODY.PEEK[{LISTING_HEADERS}])"
 
-def connect(folder: str):
-    try:
-        imap = imaplib.IMAP4_SSL(
-            host=app.config.IMAP_SERVER.host,
-            port=app.config.IMAP_SERVER.port,
-            timeout=30,
+
+def get_message(id: bytes, folder: str):
+    with pooled_connection(folder) as session:
+        status, data = session.imap.uid("fetch", id.decode(), "(RFC822)")
+        if status == "OK" and len(data) > 1:
+            return email.message_from_bytes(data[0][1])
+        return None
+
+
+def get_uidvalidity(folder: str) -> int:
+    """UIDVALIDITY папки (запоминается сессией пула при выборе папки)"""
+    with pooled_connection(folder) as session:
+        return session.uidvalidity
+
+
+def get_message_folders(id: bytes, folders: set) -> list:
+    """Папки для выборки письма id: по индексу UID, если по нему известна
+    каждая папка запроса, иначе все папки"""
+    folders = list(folders)
+    known = uid_index.lookup(id, folders) if len(folders) > 1 else {}
+    if len(known) < len(folders):
+        return folders
+    indexed = []
+    for folder, (uidvalidity, found) in known.items():
+        try:
+            current = get_uidvalidity(folder)
+        except Exception as ex:
+            logger.warning(f"{ex}")
+            current = None
+        if uidvalidity != current:
+            uid_index.forget(id, folder)
+            return folders
+        if found:
+            indexed.append(folder)
+    return indexed
+
+
+def remember_message_folder(id: bytes, folder: str, result):
+    """Запомнить в индексе UID, есть ли письмо id в папке. Отсутствие
+    запоминается только для UID меньше UIDNEXT папки"""
+    if result is not None:
+        uid_index.remember(folder, get_uidvalidity(folder), [id])
+        return
+    state = get_folder_status(folder)
+    if int(id) < (state.get("uidnext") or 0):
+        uid_index.remember(folder, state.get("uidvalidity"), [id], found=False)
+
+
+def get_folder_status(folder: str) -> dict:
+    """Состояние папки (UIDVALIDITY, UIDNEXT ...) по ответу SELECT"""
+    with pooled_connection(folder) as session:
+        return mailbox_status(session.imap, folder)
+
+
+def get_date_begin() -> datetime.datetime:
+    """Начало периода поиска писем (не ранее 1 года)"""
+    date_begin = datetime.datetime.now() - datetime.timedelta(days=365)
+    return date_begin.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def get_criteria_tokens(criteria: str) -> List[str]:
+    return [x.strip() for x in criteria.split(",") if x.strip()]
+
+
+def text_search_args(tokens: List[str]) -> List[str]:
+    """Условие поиска по любому из ИНН/ОГРН: OR TEXT a OR TEXT b TEXT c
+    (OR объединяет ровно два условия)"""
+    args = []
+    for i, token in enumerate(tokens):
+        if i < len(tokens) - 1:
+            args.append("OR")
+        args += ["TEXT", token]
+    return args
+
+
+def criteria_chunks(tokens: List[str], max_bytes: int) -> List[str]:
+    """ИНН/ОГРН, разбитые на критерии поиска ("a,b,c") так, чтобы
+    условие SEARCH каждого было не длиннее max_bytes"""
+    chunks = []
+    chunk = []
+    size = 0
+    for token in tokens:
+        # " OR TEXT <ИНН/ОГРН>"
+        token_size = len(token) + 9
+        if chunk and size + token_size > max_bytes:
+            chunks.append(",".join(chunk))
+            chunk, size = [], 0
+        chunk.append(token)
+        size += token_size
+    if chunk:
+        chunks.append(",".join(chunk))
+    return chunks
+
+
+def search_messages(criteria, folder: str, state: dict = None) -> Any:
+    """Поиск сообщений: в локальной копии папки (MIRROR.ENABLED),
+    по индексу ИНН/ОГРН, иначе с помощью серверных фильтров.
+    Результат поиска кешируется, при появлении новых писем в папке
+    поиск выполняется только среди них"""
+    if mirror.enabled():
+        try:
+            return mirror.search(criteria, folder, read_messages_from_server)
+        except MirrorIsNotReady as ex:
+            logger.info(f"{ex}")
+        except Exception as ex:
+            logger.warning(f"Поиск в локальной копии папки {folder}: {ex}")
+
+    tokens = get_criteria_tokens(criteria)
+    if state and tokens and all(token_index.is_token(x) for x in tokens):
+        uids = token_index.lookup(
+            tokens,
+            folder,
+            state.get("uidvalidity"),
+            state.get("uidnext"),
+            get_date_begin(),
         )
-    except Exception as ex:
-        logger.error(f"{ex}")
-        raise ConnectionErrorException(ex)
+        if uids is not None:
+            return [b" ".join(uids)]
 
-    try:
-        imap.login(app.config.IMAP_SERVER.user, app.config.IMAP_SERVER.password)
-    except Exception as ex:
-        logger.error(f"{ex}")
-        raise AccessDeniedException(ex)
+    date_begin = get_date_begin()
+    cached, since = search_cache.get(criteria, folder, state, date_begin)
+    if cached is not None and since is None:
+        return [b" ".join(cached)]
 
-    status, _ = imap.select(folder)
-    if status == "OK":
-        return imap
-    else:
+    args = ["UID", f"{since}:*"] if since else []
+    args += ["SENTSINCE", date_begin.strftime("%d-%b-%Y")]
+    args += text_search_args(tokens)
+
+    with pooled_connection(folder) as session:
+        criteria_text = " ".join(args).encode("utf-8")
+        status, data = session.imap.uid("search", "charset", "utf-8", criteria_text)
+    if status != "OK":
+        return None
+    uids = data[0].split() if data and data[0] else []
+    if since:
+        uids = search_cache.merge(cached, uids, since)
+    search_cache.put(criteria, folder, state, date_begin, uids)
+    return [b" ".join(uids)]
+
+
+def get_listing(ids: List[bytes], folder: str, criteria: str = "") -> dict:
+    """Данные пакета сообщений для списка писем без загрузки вложений:
+    заголовки и BODYSTRUCTURE, затем только текстовая часть письма"""
+    texts = []
+    with pooled_connection(folder) as session:
+        status, data = session.imap.uid("fetch", sequence_set(ids), LISTING_ITEMS)
+        if status != "OK":
+            # ошибка выборки - письма не считаются отсутствующими
+            raise DataIsNotFound(f"FETCH {folder}: {status}")
+        results, sections = parse_listing(data, folder, criteria)
+
+        # письма с одинаковой секцией текста выбираются одной командой
+        for section, parts in sections.items():
+            status, data = session.imap.uid(
+                "fetch",
+                sequence_set(id for id, _ in parts),
+                f"(UID BODY.PEEK[{section}])",
+            )
+            if status == "OK":
+                texts.append((parts, data, section))
+    # разбор текста - после возврата соединения в пул
+    for parts, data, section in texts:
+        set_listing_text(results, parts, data, section)
+    return results
+
+
+def parse_listing(data: list, folder: str, criteria: str = ""):
+    """Ответ FETCH LISTING_ITEMS -> результаты и текстовые части писем,
+    сгруппированные по номеру секции: {секция: [(id, часть)]}"""
+    results = {}
+    sections = {}
+    for uid, items in parse_fetch(data).items():
+        id = str(uid).encode()
         try:
-            status, folders = imap.list()
-            if folders:
-                folders = "".join([x.decode("utf-8") for x in folders]).strip("'") + "("
-                folders = ",".join(
-                    re.findall(r"(?<=\s)[A-Za-zА-Яа-я-\s]{2,}(?=\()", folders)
+            result, text_part = make_listing_result(id, folder, items, criteria)
+        except Exception as ex:
+            logger.error(f"{ex}")
+            results[id] = Result(error_message=f"{ex}")
+            continue
+        results[id] = result
+        if result and text_part:
+            sections.setdefault(text_part["section"], []).append((id, text_part))
+    return results, sections
+
+
+def set_listing_text(results: dict, parts: list, data: list, section: str):
+    """Текст писем из ответа FETCH BODY.PEEK[<секция>]"""
+    texts, errors = parse_pool.run(
+        parse_listing_text, parts, data, section, size=parse_pool.payload_size(data)
+    )
+    set_texts(results, texts, errors)
+
+
+def parse_listing_text(parts: list, data: list, section: str):
+    """Ответ FETCH BODY.PEEK[<секция>] -> ({id: текст письма}, {id: ошибка})"""
+    texts = {}
+    errors = {}
+    items = parse_fetch(data)
+    for id, part in parts:
+        payload = items.get(int(id), {}).get(f"BODY[{section}]")
+        if not payload:
+            continue
+        try:
+            texts[id] = part_to_text(
+                decode_payload(payload, part["encoding"], part["params"].get("charset")),
+                part["type"],
+            )
+        except Exception as ex:
+            errors[id] = f"{ex}"
+    return texts, errors
+
+
+def make_listing_result(id: bytes, folder: str, items: dict, criteria: str = ""):
+    """Данные сообщения по заголовкам и BODYSTRUCTURE.
+    Возвращает результат (NO_ATTACHMENTS для письма без вложений)
+    и текстовую часть письма для загрузки"""
+    headers = next(
+        (v for k, v in items.items() if k.startswith("BODY[HEADER.FIELDS")), b""
+    )
+    msg = BytesHeaderParser().parsebytes(headers or b"")
+    result = Result(criteria=criteria)
+    result.criteria = criteria
+    result.path = folder
+    result.id = id
+    result.sender = get_email_from_message(msg)
+    result.date = get_date_from_message(msg)
+    result.subject = get_subject(msg)
+    text_part = None
+    for part in body_parts(items.get("BODYSTRUCTURE")):
+        if part["disposition"] == "attachment":
+            filename = decode_file_name(part_filename(part))
+            if filename:
+                result.files.append(
+                    Result.file_info(
+                        part["section"], filename, part["size"], part["type"]
+                    )
                 )
-        finally:
-            imap.logout()
-            raise InboxIsNotSelected(f"{folder}. Список доступных папок: {folders}")
+        elif part["type"].startswith("text/"):
+            if text_part is None or text_rank(part["type"]) < text_rank(
+                text_part["type"]
+            ):
+                text_part = part
+    return (result, text_part) if result.files else (NO_ATTACHMENTS, None)
+
+
+def get_attachment_parts(id: bytes, folder: str, att_ids: str):
+    """Запрошенные вложения письма по BODYSTRUCTURE:
+    (UIDVALIDITY папки, [(описание, часть)])"""
+    with pooled_connection(folder) as session:
+        status, data = session.imap.uid("fetch", id.decode(), "(UID BODYSTRUCTURE)")
+        uidvalidity = session.uidvalidity
+    if status != "OK":
+        return uidvalidity, []
+    return uidvalidity, select_attachment_parts(
+        parse_fetch(data).get(int(id), {}), att_ids
+    )
 
 
-def disconnect(imap):
-    try:
-        imap.close()
-    finally:
-        imap.logout()
+def select_attachment_parts(items: dict, att_ids: str) -> list:
+    selected = []
+    for part in body_parts(items.get("BODYSTRUCTURE")):
+        if part["disposition"] == "attachment":
+            filename = decode_file_name(part_filename(part))
+            if filename:
+                file = Result.file_info(
+                    part["section"], filename, part["size"], part["type"]
+                )
+                if Result.file_selected(file, att_ids):
+                    selected.append((file, part))
+    return selected
+
+
+def section_chunk_items(part: dict, offset: int) -> str:
+    size = app.config.IMAP_FETCH.CHUNK_SIZE
+    return f"(UID BODY.PEEK[{part['section']}]<{offset}.{size}>)"
+
+
+def get_section_chunk(data: list, id: bytes, part: dict) -> bytes:
+    items = parse_fetch(data).get(int(id), {})
+    prefix = f"BODY[{part['section']}]"
+    return next((v for k, v in items.items() if k.startswith(prefix)), None) or b""
+
+
+def download_section(id: bytes, folder: str, part: dict, filename):
+    """Загрузка одной секции письма частями BODY.PEEK[<секция>]<смещение.размер>
+    с потоковым декодированием в файл"""
+    decoder = PayloadDecoder(part["encoding"])
+    offset = 0
+    with pooled_connection(folder) as session, open(filename, mode="wb") as f:
+        while True:
+            status, data = session.imap.uid(
+                "fetch", id.decode(), section_chunk_items(part, offset)
+            )
+            if status != "OK":
+                raise DataIsNotFound(f"секция {part['section']} письма {id.decode()}")
+            chunk = get_section_chunk(data, id, part)
+            f.write(decoder.feed(chunk))
+            offset += len(chunk)
+            if len(chunk) < app.config.IMAP_FETCH.CHUNK_SIZE:
+                break
+        f.write(decoder.flush())
+
+
+def get_output_path() -> Path:
+    """Новый каталог для файлов вложений"""
+    path = Path(
+        Path(__file__).resolve().parent.parent,
+        get_name_template(app.config.OUTPUT_DIR),
+    )
+    path.mkdir(parents=True, exist_ok=True)
+    return path
 
 
-# Пул для повторного использования соединений IMAP
-def pooled_connection(folder: str):
-    return connection_pool.submit(connect, folder)
+def download_attachments(id: bytes, folder: str, att_ids: str):
+    """Загрузка запрошенных вложений письма без загрузки письма целиком.
+    Загруженные вложения сохраняются в дисковом кеше (BLOB_CACHE)"""
+    uidvalidity, selected = get_attachment_parts(id, folder, att_ids)
+    if not selected:
+        return None
+    if not blob_cache.enabled():
+        files = []
+        path = get_output_path()
+        for file, part in selected:
+            filename = unique_name(file["name"], files)
+            download_section(id, folder, part, Path(path, filename))
+            files.append(filename)
+        return make_archive(path, files) if len(files) > 1 else Path(path, files[0])
 
+    blobs = []
+    for file, part in selected:
+        key = (folder, uidvalidity, id.decode(), part["section"])
+        blob = blob_cache.get(key)
+        if blob is None:
+            staging = blob_cache.staging_path()
+            try:
+                download_section(id, folder, part, staging)
+                blob = cache_attachment(key, staging, file["name"])
+            finally:
+                staging.unlink(missing_ok=True)
+        blobs.append(blob)
+    return get_cached_attachments(blobs)
+
+
+def cache_attachment(key: tuple, staging: Path, name: str) -> Path:
+    """Загруженное вложение в кеш. Файл больше BLOB_CACHE.MAX_BYTES
+    переносится во временный каталог и удаляется после отправки"""
+    blob = blob_cache.put(key, staging, name)
+    if blob is None:
+        blob = Path(get_output_path(), unique_name(name, []))
+        shutil.move(staging, blob)
+    return blob
+
+
+def get_cached_attachments(blobs: list):
+    """Одно вложение отдается из кеша, несколько - архивом во временном каталоге"""
+    if len(blobs) == 1:
+        return blobs[0]
+    files = []
+    path = get_output_path()
+    for blob in blobs:
+        filename = unique_name(blob.name, files)
+        blob_cache.link(blob, Path(path, filename))
+        files.append(filename)
+    return make_archive(path, files)
+
+
+def make_result(id: bytes, folder: str, raw: bytes, criteria: str = ""):
+    """Данные сообщения для списка писем по исходному тексту письма.
+    Разбираются только заголовки частей, вложения не декодируются.
+    Возвращает результат (NO_ATTACHMENTS для письма без вложений)
+    и текстовую часть письма (с содержимым)"""
+    msg, parts = scan(raw)
+    result = Result(criteria=criteria)
+    result.criteria = criteria
+    result.path = folder
+    result.id = id
+    result.sender = get_email_from_message(msg)
+    result.date = get_date_from_message(msg)
+    result.subject = get_subject(msg)
+    text_part = None
+    for part in parts:
+        if part["disposition"] == "attachment":
+            filename = decode_file_name(part["filename"])
+            if filename:
+                result.files.append(
+                    Result.file_info(
+                        part["section"], filename, part["size"], part["type"]
+                    )
+                )
+        elif part["payload"] is not None:
+            if text_part is None or text_rank(part["type"]) < text_rank(
+                text_part["type"]
+            ):
+                text_part = part
+    if not result.files:
+        return NO_ATTACHMENTS, None
+    return result, text_part
+
+
+# Разобранные письма воркера: только извлеченные поля, без объектов Message
+parsed_messages = LocalCache(
+    maxsize=app.config.PARSED_CACHE.MAX_SIZE,
+    max_bytes=app.config.PARSED_CACHE.MAX_BYTES,
+    ttl=app.config.PARSED_CACHE.TTL_SECONDS,
+)
 
-def get_message(id: bytes, folder: str):
-    imap = connect(folder)
-    try:
-        status, data = imap.uid("fetch", id.decode(), "(RFC822)")
-        if status == "OK" and len(data) > 1:
-            return email.message_from_bytes(data[0][1])
-        return None
-    finally:
-        disconnect(imap)
+
+def lookup_parsed(ids: List[bytes], folder: str, uidvalidity: int, criteria: str = ""):
+    """Результаты из кеша разобранных писем по (папка, UIDVALIDITY, UID, критерий)
+    и список писем, которые нужно выбрать с сервера. Фрагмент текста и
+    выделения в записи зависят от критерия поиска, поэтому он входит в ключ"""
+    results = {}
+    missing = []
+    for id in ids:
+        found, record = parsed_messages.get((folder, uidvalidity, int(id), criteria))
+        if not found:
+            missing.append(id)
+        elif record:
+            results[id] = Result.from_record(record)
+        else:
+            results[id] = record
+    return results, missing
+
+
+def store_parsed(results: dict, folder: str, uidvalidity: int, criteria: str = ""):
+    for id, result in results.items():
+        if result and result.error:
+            continue
+        record = result.to_record() if result else result
+        parsed_messages.set(
+            (folder, uidvalidity, int(id), criteria),
+            record,
+            len(json.dumps(record, ensure_ascii=False)),
+        )
 
 
-def search_messages(criteria, folder: str) -> Any:
-    """Поиск сообщений с помощью серверных фильтров"""
-    imap = connect(folder)
-    date_begin = (datetime.datetime.now() - datetime.timedelta(days=365)).strftime(
-        "%d-%b-%Y"
+def read_messages(ids: List[bytes], folder: str, criteria: str = "") -> dict:
+    """Выборка данных пакета сообщений: из кеша разобранных писем,
+    остальные с сервера"""
+    uidvalidity = get_uidvalidity(folder)
+    results, missing = lookup_parsed(ids, folder, uidvalidity, criteria)
+    if missing:
+        fetched = read_messages_from_server(missing, folder, criteria)
+        store_parsed(fetched, folder, uidvalidity, criteria)
+        results.update(fetched)
+    return results
+
+
+def read_messages_from_server(ids: List[bytes], folder: str, criteria: str = ""):
+    """Выборка данных пакета сообщений с сервера.
+    IMAP_FETCH.MODE: structure - без загрузки вложений, full - письма целиком.
+    Письма, которых нет в ответе FETCH, отсутствуют в папке; при ошибке
+    FETCH возбуждается DataIsNotFound"""
+    if app.config.IMAP_FETCH.MODE != "full":
+        return get_listing(ids, folder, criteria)
+
+    # пакет писем одной командой UID FETCH <набор UID>
+    with pooled_connection(folder) as session:
+        status, data = session.imap.uid("fetch", sequence_set(ids), "(UID RFC822)")
+    if status != "OK":
+        raise DataIsNotFound(f"FETCH {folder}: {status}")
+    results, parts = parse_messages(data, ids, folder, criteria)
+    set_message_text(results, parts)
+    return results
+
+
+def parse_messages(data: list, ids: List[bytes], folder: str, criteria: str = ""):
+    """Ответ FETCH RFC822 -> результаты по идентификаторам писем и
+    текстовые части писем [(id, часть)]. Выполняется в текущем потоке:
+    границы частей находятся без копирования вложений"""
+    messages = parse_fetch(data)
+    results = {}
+    parts = []
+    for id in ids:
+        raw = messages.get(int(id), {}).get("RFC822")
+        try:
+            results[id], text_part = (
+                make_result(id, folder, raw, criteria) if raw else (None, None)
+            )
+        except Exception as ex:
+            logger.error(f"{ex}")
+            results[id] = Result(error_message=f"{ex}")
+            continue
+        if text_part:
+            parts.append((id, text_part))
+    return results, parts
+
+
+def set_message_text(results: dict, parts: list):
+    """Текст писем по текстовым частям: в пул процессов передается только
+    содержимое текстовых частей, без вложений"""
+    texts, errors = parse_pool.run(
+        parse_message_text,
+        parts,
+        size=sum(len(part["payload"]) for _, part in parts),
     )
-    args = ["SENTSINCE", date_begin]
-    criteria_list = criteria.split(",")
-    if len(criteria_list) > 1:
-        args.append("OR")
-    for cr in criteria_list:
-        args.append("TEXT")
-        args.append(cr.strip())
+    set_texts(results, texts, errors)
+
+
+def parse_message_text(parts: list):
+    """Текстовые части писем -> ({id: текст}, {id: ошибка})"""
+    texts = {}
+    errors = {}
+    for id, part in parts:
+        try:
+            texts[id] = part_to_text(
+                decode_payload(part["payload"], part["encoding"], part["charset"]),
+                part["type"],
+            )
+        except Exception as ex:
+            errors[id] = f"{ex}"
+    return texts, errors
 
-    try:
-        criteria_text = " ".join(args).encode("utf-8")
-        status, data = imap.uid("search", "charset", "utf-8", criteria_text)
-        if status == "OK":
-            return data
-        return None
-    finally:
-        disconnect(imap)
+
+def set_texts(results: dict, texts: dict, errors: dict):
+    """Текст в результатах; письмо с ошибкой разбора текста - результат
+    с error, остальные письма пакета не затрагиваются"""
+    for id, text in texts.items():
+        results[id].set_body(text)
+    for id, error in errors.items():
+        logger.error(error)
+        results[id] = Result(error_message=error)
 
 
 @cache(expiration_seconds=app.config.REDIS.EXPIRATION_SECONDS)
 def get_message_data(id: bytes, folder: str, criteria: str = ""):
     """Выборка данных сообщения"""
-    # Преобразование id (bytes) в строку для кеширования
-    id_str = id.decode("utf-8")
-    msg = get_message(id, folder)
-    if msg:
-        result = Result(criteria=criteria)
-        result.criteria = criteria
-        result.path = folder
-        result.id = id
-        result.sender = get_email_from_message(msg)
-        result.date = get_date_from_message(msg)
-        result.subject = get_subject(msg)
-        result.body, result.files = get_body(msg)
-        return result if result.files else None
-    return None
+    result = read_messages([id], folder, criteria).get(id)
+    if result and result.error:
+        raise DataIsNotFound(result.error)
+    return result
+
+
+def get_messages_data(ids: List[bytes], folder: str, criteria: str = "") -> dict:
+    """Выборка данных пакета сообщений, результаты сохраняются
+    в кеше get_message_data"""
+    results = read_messages(ids, folder, criteria)
+    for id in ids:
+        results.setdefault(id, None)
+    get_message_data.store_many(
+        [
+            ((id, folder, criteria), result)
+            for id, result in results.items()
+            if not (result and result.error)
+        ]
+    )
+    return results
+
+
+def read_messages_cached(ids: List[bytes], folder: str, criteria: str = "") -> dict:
+    """Данные писем из кеша, отсутствующие выбираются с сервера пакетами.
+    Одни и те же письма выбирает только один запрос (во всех воркерах),
+    остальные ожидают их появления в кеше. Ошибки - результаты с error"""
+
+    def fetch(keys: list) -> dict:
+        values = {}
+        with ThreadPoolExecutor(max_workers=app.config.IMAP_FETCH.WORKERS) as executor:
+            futures = {
+                executor.submit(get_messages_data, batch, folder, criteria): batch
+                for batch in batches(
+                    [id for id, _, _ in keys], app.config.IMAP_FETCH.BATCH_SIZE
+                )
+            }
+            for future in as_completed(futures):
+                try:
+                    for id, result in future.result().items():
+                        values[(id, folder, criteria)] = (
+                            CachedFailure(result.error)
+                            if result and result.error
+                            else result
+                        )
+                except Exception as ex:
+                    for id in futures[future]:
+                        values[(id, folder, criteria)] = ex
+        return values
+
+    values = get_message_data.get_many([(id, folder, criteria) for id in ids], fetch)
+    return {
+        id: Result(error_message=f"{value}")
+        if isinstance(value, CachedFailure)
+        else value
+        for (id, _, _), value in values.items()
+    }
 
 
 def fetch_messages(criteria: str, folders: List[str]):
@@ -156,7 +662,6 @@ def fetch_messages(criteria: str, folders: List[str]):
         return []
 
 
-@lru_cache(maxsize=1024)
 def get_subject(msg) -> str:
     try:
         subject = decode_header(msg["Subject"])[0][0]
@@ -166,74 +671,63 @@ def get_subject(msg) -> str:
         return ""
 
 
-@lru_cache(maxsize=1024)
 def get_date_from_message(msg):
     return email.utils.parsedate_to_datetime(msg["Date"]) if msg else None
 
 
-@lru_cache(maxsize=1024)
 def get_email_from_message(msg):
     return msg["Return-path"] if msg else None
 
 
-def get_body_text(part) -> str:
-    encode = get_Transfer_Encoding(part)
-    payload = part.get_payload()
-    contents = (
-        email.base64mime.decode(payload)
-        if encode == "base64"
-        else (
-            decode_quoted_printable(payload)
-            if encode == "quoted-printable"
-            else payload
-        )
-    )
-    soup = BeautifulSoup(contents, "html.parser")
-    return re.sub(r"(\n)+", r"\n", soup.text)
+def text_rank(content_type: str) -> int:
+    """Предпочтение текстовых частей: text/plain, затем text/html"""
+    return {"text/plain": 0, "text/html": 1}.get(content_type, 2)
 
 
-@lru_cache(maxsize=1024)
 def get_file_name(part):
-    filename = decode_header(part.get_filename())[0][0]
-    return filename.decode() if isinstance(filename, bytes) else filename
+    return decode_file_name(part.get_filename())
 
 
-def get_Transfer_Encoding(part):
-    encoding = part.get("Content-Transfer-Encoding", "").lower()
-    return encoding
+def decode_file_name(filename: str) -> str:
+    if not filename:
+        return ""
+    filename = decode_header(filename)[0][0]
+    return filename.decode() if isinstance(filename, bytes) else filename
 
 
-def get_body(msg) -> Tuple[str, list]:
-    text = ""
-    files = []
-    for part in msg.walk():
-        if part.get_content_disposition() == "attachment":
-            filename = get_file_name(part)
-            if filename:
-                files.append({"id": Result.hashit(filename), "name": filename})
-        elif part.get_content_maintype() == "text":
-            text = get_body_text(part)
-    return text, files
+def walk_sections(msg, section: str = ""):
+    """Обход частей письма с номерами секций IMAP: (секция, часть)"""
+    if msg.get_content_type() == "message/rfc822" and section:
+        if msg.get_content_disposition() == "attachment":
+            yield section, msg
+            return
+        inner = msg.get_payload(0)
+        if inner.is_multipart():
+            yield from walk_sections(inner, section)
+        else:
+            yield f"{section}.1", inner
+    elif msg.is_multipart():
+        for n, part in enumerate(msg.get_payload(), 1):
+            yield from walk_sections(part, f"{section}.{n}" if section else str(n))
+    else:
+        yield section or "1", msg
 
 
 def extract_attachments(msg, att_ids):
     files = []
-    path = Path(
-        Path(__file__).resolve().parent.parent,
-        get_name_template(app.config.OUTPUT_DIR),
-    )
-    path.mkdir(parents=True, exist_ok=True)
+    path = get_output_path()
 
-    for part in msg.walk():
+    for section, part in walk_sections(msg):
         if part.get_content_disposition() == "attachment":
             filename = get_file_name(part)
-            contents = part.get_payload(decode=True)
-            if not filename in files:
-                if (not att_ids or att_ids == "0") or Result.hashit(
-                    filename
-                ) in att_ids:
-                    files.append(filename)
-                    write_contents(Path(path, filename), contents)
+            if not filename:
+                continue
+            size = 0 if part.is_multipart() else len(part.get_payload())
+            file = Result.file_info(section, filename, size, part.get_content_type())
+            if Result.file_selected(file, att_ids):
+                filename = unique_name(filename, files)
+                files.append(filename)
+                write_contents(Path(path, filename), part.get_payload(decode=True))
 
     if files:
         return make_archive(path, files) if len(files) > 1 else Path(path, files[0])
@@ -274,53 +768,220 @@ def process_folder(criteria: str, folder: str):
     """Обработка одной папки и возврат результатов и ошибок"""
     folder_results = []
     folder_errors = []
-    data = search_messages(criteria, folder)
+    try:
+        state = get_folder_status(folder)
+    except Exception as ex:
+        logger.warning(f"{ex}")
+        state = {}
+    data = search_messages(criteria, folder, state)
     if data:
-        with ThreadPoolExecutor(max_workers=8) as message_executor:
-            future_to_message = {
-                message_executor.submit(get_message_data, id, folder, criteria): id
-                for id in data[0].split()[:100]  # Ограничим до 200 первых сообщений
-            }
-
-            for future in as_completed(future_to_message):
-                try:
-                    result = future.result()
-                    if result:
-                        folder_results.append(result)
-                except Exception as ex:
-                    folder_errors.append(Result(error_message=f"{ex}"))
+        uids = data[0].split()
+        # Ограничим до 100 первых сообщений
+        for result in read_messages_cached(uids[:100], folder, criteria).values():
+            if result and result.error:
+                folder_errors.append(result)
+            elif result:
+                folder_results.append(result)
+
+        uidvalidity = state.get("uidvalidity") or get_uidvalidity(folder)
+        if folder_results:
+            uid_index.remember(folder, uidvalidity, [x.id for x in folder_results])
+
+        # результаты поиска по одному ИНН/ОГРН полностью попадают в индекс
+        tokens = get_criteria_tokens(criteria)
+        single = len(tokens) == 1 and token_index.is_token(tokens[0])
+        token_index.add(folder, uidvalidity, folder_results, tokens if single else ())
+        if single and len(uids) <= 100 and not folder_errors:
+            token_index.cover(tokens[0], folder, uidvalidity, state.get("uidnext"))
 
     return folder_results, folder_errors
 
 
-def fetch_message(id: bytes, folders: set):
-    """Выборка сообщения по идентификатору"""
+def get_results(handles: list, criteria: str) -> list:
+    """Результаты по ссылкам курсора (папка, UID) в исходном порядке.
+    Письма берутся из кеша, отсутствующие выбираются с сервера"""
+    found = {}
+    folders = {}
+    for handle in handles:
+        if "id" in handle:
+            folders.setdefault(handle["path"], []).append(handle["id"].encode())
+    for folder, ids in folders.items():
+        for id, result in read_messages_cached(ids, folder, criteria).items():
+            found[(folder, id)] = result
     results = []
+    for handle in handles:
+        if "id" in handle:
+            result = found.get((handle["path"], handle["id"].encode()))
+            if result:
+                results.append(result)
+        else:
+            results.append(Result(error_message=handle["error"]))
+    return results
+
+
+def get_bodies(results: list, criteria: str = "") -> list:
+    """Результаты с полным текстом писем (fields=body).
+    Текст не хранится в кеше, поэтому письма выбираются с сервера"""
+    folders = {}
+    for result in results:
+        if not result.error:
+            folders.setdefault(result.path, []).append(result.id)
+    fetched = {}
+    for folder, ids in folders.items():
+        for id, result in read_messages_from_server(ids, folder, criteria).items():
+            fetched[(folder, id)] = result
+    return [fetched.get((x.path, x.id)) or x for x in results]
+
+
+def fetch_batch(tokens: List[str], folders) -> tuple:
+    """Пакетный поиск писем по списку ИНН/ОГРН.
+    В каждой папке выполняется поиск объединенными условиями OR TEXT,
+    каждое найденное письмо выбирается один раз, затем результаты
+    распределяются по ИНН/ОГРН: ({ИНН/ОГРН: [результаты]}, [ошибки])"""
+    matcher = Matcher(tokens)
+    found = {token: [] for token in matcher.terms}
+    error_results = []
 
     with ThreadPoolExecutor(max_workers=4) as folder_executor:
         futures = [
-            folder_executor.submit(get_message_data, id, folder) for folder in folders
+            folder_executor.submit(process_batch_folder, matcher, folder)
+            for folder in folders
+        ]
+        for future in as_completed(futures):
+            try:
+                folder_results, folder_errors = future.result()
+            except Exception as ex:
+                logger.error(f"Ошибка обработки папки: {ex}")
+                error_results.append(Result(error_message=f"Ошибка папки: {ex}"))
+                continue
+            for token, results in folder_results.items():
+                found[token] += results
+            error_results += folder_errors
+
+    for token, results in found.items():
+        results.sort(key=lambda x: x.date, reverse=True)
+        del results[app.config.BATCH.MAX_RESULTS :]
+    return found, error_results
+
+
+def process_batch_folder(matcher: Matcher, folder: str) -> tuple:
+    """Пакетный поиск в одной папке: ({ИНН/ОГРН: [результаты]}, [ошибки])"""
+    try:
+        state = get_folder_status(folder)
+    except Exception as ex:
+        logger.warning(f"{ex}")
+        state = {}
+    uids = {}
+    for criteria in criteria_chunks(matcher.terms, app.config.BATCH.MAX_COMMAND_BYTES):
+        data = search_messages(criteria, folder, state)
+        for uid in data[0].split() if data else []:
+            uids.setdefault(uid, []).append(criteria)
+    # новые письма - в начале
+    ids = sorted(uids, key=int, reverse=True)[: app.config.BATCH.MAX_MESSAGES]
+
+    messages = {}
+    folder_errors = []
+    with ThreadPoolExecutor(max_workers=app.config.IMAP_FETCH.WORKERS) as executor:
+        futures = [
+            executor.submit(read_messages_from_server, batch, folder)
+            for batch in batches(ids, app.config.IMAP_FETCH.BATCH_SIZE)
         ]
+        for future in as_completed(futures):
+            try:
+                for id, result in future.result().items():
+                    if result and result.error:
+                        folder_errors.append(result)
+                    elif result:
+                        messages[id] = result
+            except Exception as ex:
+                folder_errors.append(Result(error_message=f"{ex}"))
+
+    # ИНН/ОГРН письма - по тексту письма, иначе поиском на сервере
+    matched = {}
+    unmatched = {}
+    for id, result in messages.items():
+        matched[id] = matcher.found(
+            result.subject, result.body, *[x["name"] for x in result.files]
+        )
+        if not matched[id]:
+            for criteria in uids[id]:
+                unmatched.setdefault(criteria, []).append(id)
+    for criteria, ids in unmatched.items():
+        tokens = get_criteria_tokens(criteria)
+        for id, found in search_tokens(tokens, ids, folder).items():
+            matched[id] |= found
+
+    folder_results = {}
+    for id, tokens in matched.items():
+        for token in tokens:
+            folder_results.setdefault(token, []).append(
+                split_result(messages[id], token)
+            )
+    return folder_results, folder_errors
+
+
+def search_tokens(tokens: List[str], ids: List[bytes], folder: str) -> dict:
+    """Какие из ИНН/ОГРН сервер находит в письмах ids: {id: {ИНН/ОГРН}}"""
+    found = {}
+    with pooled_connection(folder) as session:
+        for token in tokens:
+            criteria_text = f"UID {sequence_set(ids)} TEXT {token}".encode("utf-8")
+            status, data = session.imap.uid(
+                "search", "charset", "utf-8", criteria_text
+            )
+            if status == "OK" and data and data[0]:
+                for id in data[0].split():
+                    found.setdefault(id, set()).add(token)
+    return found
+
+
+def split_result(result: Result, token: str) -> Result:
+    """Копия результата пакетного поиска для одного ИНН/ОГРН
+    (фрагмент текста - вокруг этого ИНН/ОГРН)"""
+    copy = Result.from_record(result.to_record() | {"criteria": token})
+    if result.body:
+        copy.set_body(result.body)
+    return copy
+
+
+def fetch_message(id: bytes, folders: set):
+    """Выборка сообщения по идентификатору"""
+    found = []
+
+    with ThreadPoolExecutor(max_workers=4) as folder_executor:
+        futures = {
+            folder_executor.submit(get_message_data, id, folder): folder
+            for folder in get_message_folders(id, folders)
+        }
 
         for future in as_completed(futures):
-            result = future.result()
-            if result:
-                results.append(result)
+            found.append((futures[future], future.result()))
 
-    return results
+    for folder, result in found:
+        remember_message_folder(id, folder, result)
+    return [result for _, result in found if result]
+
+
+def get_attachments(id: bytes, folder: str, att_id: str = ""):
+    """Вложения письма в папке: по секциям или из письма целиком"""
+    if app.config.IMAP_FETCH.MODE != "full":
+        return download_attachments(id, folder, att_id)
+    msg = get_message(id, folder)
+    return extract_attachments(msg, att_id) if msg else None
 
 
 def fetch_attachments(id: str, folders: set, att_id: str = ""):
     """Получить вложение письма"""
     with ThreadPoolExecutor(max_workers=4) as folder_executor:
         futures = [
-            folder_executor.submit(get_message, id, folder) for folder in folders
+            folder_executor.submit(get_attachments, id, folder, att_id)
+            for folder in get_message_folders(id, folders)
         ]
 
         for future in as_completed(futures):
-            msg = future.result()
-            if msg:
-                return extract_attachments(msg, att_id)
+            filename = future.result()
+            if filename:
+                return filename
 
     return None
 
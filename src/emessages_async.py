@@ -0,0 +1,711 @@
+import os
+import re
+import time
+import email
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from collections import deque
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import List
+import aioimaplib
+from .result import Result
+from .helpers import make_archive, unique_name, PayloadDecoder
+from src import (
+    app,
+    uid_index,
+    mirror,
+    token_index,
+    search_cache,
+    blob_cache,
+)
+from src.imap_response import sequence_set, batches, parse_fetch
+from src.emessages import (
+    LISTING_ITEMS,
+    get_date_begin,
+    get_criteria_tokens,
+    text_search_args,
+    get_message_data,
+    parse_listing,
+    set_listing_text,
+    parse_messages,
+    set_message_text,
+    lookup_parsed,
+    read_messages_from_server,
+    store_parsed,
+    select_attachment_parts,
+    section_chunk_items,
+    get_section_chunk,
+    get_output_path,
+    cache_attachment,
+    get_cached_attachments,
+    extract_attachments,
+)
+from .exceptions import *
+
+logger = logging.getLogger(__name__)
+
+_LITERAL = re.compile(rb"\{\d+\}$")
+
+# --------------------------------------------------------------------------
+# Общий цикл событий воркера: запросы Flask выполняют корутины в нем
+
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop, _loop_pid
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(
+                target=_loop.run_forever, name="imap-async", daemon=True
+            ).start()
+    return _loop
+
+
+def run(coro, timeout: float = None):
+    """Выполнить корутину в цикле событий воркера и дождаться результата
+    не дольше timeout (по умолчанию IMAP_ASYNC.TIMEOUT_SECONDS)"""
+    future = asyncio.run_coroutine_threadsafe(coro, get_loop())
+    try:
+        return future.result(timeout or app.config.IMAP_ASYNC.TIMEOUT_SECONDS)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+
+# --------------------------------------------------------------------------
+# Пул асинхронных сессий
+
+
+async def login_async():
+    try:
+        imap = aioimaplib.IMAP4_SSL(
+            host=app.config.IMAP_SERVER.host,
+            port=app.config.IMAP_SERVER.port,
+            timeout=30,
+        )
+        await imap.wait_hello_from_server()
+    except Exception as ex:
+        logger.error(f"{ex}")
+        raise ConnectionErrorException(ex)
+
+    response = await imap.login(
+        app.config.IMAP_SERVER.user, app.config.IMAP_SERVER.password
+    )
+    if response.result != "OK":
+        await logout_async(imap)
+        raise AccessDeniedException()
+    return imap
+
+
+async def select_async(imap, folder: str) -> int:
+    """Выбрать папку, возвращает UIDVALIDITY папки"""
+    response = await imap.select(folder)
+    if response.result != "OK":
+        raise InboxIsNotSelected(folder)
+    for line in response.lines:
+        found = re.search(rb"UIDVALIDITY (\d+)", bytes(line))
+        if found:
+            return int(found.group(1))
+    return 0
+
+
+async def logout_async(imap):
+    try:
+        await imap.logout()
+    except Exception as ex:
+        logger.debug(f"{ex}")
+
+
+class AsyncSession:
+    def __init__(self, imap, folder: str = None, uidvalidity: int = 0):
+        self.imap = imap
+        self.folder = folder
+        self.uidvalidity = uidvalidity
+        self.created = time.monotonic()
+        self.used = self.created
+        self.checked = self.created
+
+
+class AsyncConnectionPool:
+    """Пул сессий aioimaplib в цикле событий воркера.
+    Параметры те же, что у пула синхронных сессий (IMAP_POOL)"""
+
+    def __init__(self):
+        config = app.config.IMAP_POOL
+        self.max_size = config.MAX_SIZE
+        self.max_idle = config.MAX_IDLE_SECONDS
+        self.max_lifetime = config.MAX_LIFETIME_SECONDS
+        self.noop_interval = config.NOOP_INTERVAL_SECONDS
+        self.timeout = config.ACQUIRE_TIMEOUT_SECONDS
+        self._idle = {}
+        self._size = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, folder: str) -> AsyncSession:
+        session = await self._take(folder)
+        if session and (self._expired(session) or not await self._alive(session)):
+            await logout_async(session.imap)
+            session = None
+        try:
+            if session is None:
+                session = AsyncSession(await login_async())
+            if session.folder != folder:
+                session.folder = None
+                session.uidvalidity = await select_async(session.imap, folder)
+                session.folder = folder
+        except InboxIsNotSelected:
+            await self.release(session)
+            raise
+        except Exception:
+            if session:
+                await logout_async(session.imap)
+            await self._free()
+            raise
+        return session
+
+    async def release(self, session: AsyncSession, broken: bool = False):
+        if broken or self._expired(session):
+            await logout_async(session.imap)
+            await self._free()
+            return
+        session.used = time.monotonic()
+        async with self._cond:
+            self._idle.setdefault(session.folder, deque()).append(session)
+            self._cond.notify()
+
+    def in_use(self) -> int:
+        """Количество выданных сессий (для проверки из других потоков)"""
+        return self._size - sum(len(idle) for idle in list(self._idle.values()))
+
+    async def _take(self, folder: str):
+        """Свободная сессия (своей папки, затем любой) или None,
+        если разрешено открыть новую. Ожидает, если пул исчерпан."""
+        async with self._cond:
+            try:
+                await asyncio.wait_for(
+                    self._cond.wait_for(
+                        lambda: self._idle.get(folder)
+                        or self._size < self.max_size
+                        or any(self._idle.values())
+                    ),
+                    self.timeout,
+                )
+            except asyncio.TimeoutError:
+                raise ConnectionErrorException("(пул IMAP-соединений исчерпан)")
+            if self._idle.get(folder):
+                return self._idle[folder].pop()
+            if self._size < self.max_size:
+                self._size += 1
+                return None
+            return next(idle for idle in self._idle.values() if idle).pop()
+
+    async def _alive(self, session: AsyncSession) -> bool:
+        now = time.monotonic()
+        if now - session.checked < self.noop_interval:
+            return True
+        try:
+            response = await session.imap.noop()
+        except Exception as ex:
+            logger.debug(f"{ex}")
+            return False
+        session.checked = now
+        return response.result == "OK"
+
+    def _expired(self, session: AsyncSession) -> bool:
+        now = time.monotonic()
+        return (
+            now - session.created > self.max_lifetime
+            or now - session.used > self.max_idle
+        )
+
+    async def _free(self):
+        async with self._cond:
+            if self._size > 0:
+                self._size -= 1
+            self._cond.notify()
+
+
+_pool = None
+_pool_pid = None
+
+
+def get_pool() -> AsyncConnectionPool:
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = AsyncConnectionPool()
+        _pool_pid = os.getpid()
+    return _pool
+
+
+@asynccontextmanager
+async def pooled_connection_async(folder: str):
+    """Сессия из асинхронного пула с выбранной папкой folder"""
+    session = await get_pool().acquire(folder)
+    try:
+        yield session
+    except (aioimaplib.Abort, OSError, asyncio.TimeoutError):
+        await get_pool().release(session, broken=True)
+        raise
+    except BaseException:
+        await get_pool().release(session)
+        raise
+    else:
+        await get_pool().release(session)
+
+
+def fetch_data(response) -> list:
+    """Строки ответа aioimaplib -> ответ в формате imaplib:
+    строки bytes и пары (строка, литерал)"""
+    data = []
+    for line in response.lines:
+        if (
+            isinstance(line, bytearray)
+            and data
+            and isinstance(data[-1], bytes)
+            and _LITERAL.search(data[-1])
+        ):
+            data[-1] = (data[-1], bytes(line))
+        else:
+            data.append(bytes(line))
+    return data
+
+
+# --------------------------------------------------------------------------
+
+
+async def uid_fetch_async(
+    session: AsyncSession, ids, items: str, required: bool = False
+) -> list:
+    """Ответ UID FETCH. При ошибке - пустой ответ, а если выборка
+    обязательна (required) - исключение DataIsNotFound"""
+    response = await session.imap.uid("fetch", sequence_set(ids), items)
+    if response.result != "OK":
+        if required:
+            raise DataIsNotFound(f"FETCH {session.folder}: {response.result}")
+        return []
+    return fetch_data(response)
+
+
+async def folder_status_async(session: AsyncSession, folder: str) -> dict:
+    """Состояние папки по ответу повторного SELECT (см. imap_pool.status)"""
+    response = await session.imap.select(folder)
+    if response.result != "OK":
+        return {}
+    state = {}
+    for line in response.lines:
+        line = bytes(line)
+        found = re.search(rb"(\d+) EXISTS", line)
+        if found:
+            state["messages"] = int(found.group(1))
+        for key, value in re.findall(
+            rb"\[(UIDNEXT|UIDVALIDITY|HIGHESTMODSEQ) (\d+)\]", line
+        ):
+            state[key.decode().lower()] = int(value)
+    return state
+
+
+async def search_messages_async(criteria: str, folder: str, state: dict) -> List:
+    """Поиск писем не ранее 1 года по индексу ИНН/ОГРН, в кеше поиска или на сервере.
+    Если критериев поиска несколько, то ищется по любому из них.
+    Локальная копия папки (MIRROR.ENABLED) синхронизируется через пул imaplib"""
+    if mirror.enabled():
+        try:
+            data = await asyncio.to_thread(
+                mirror.search, criteria, folder, read_messages_from_server
+            )
+            return data[0].split()
+        except MirrorIsNotReady as ex:
+            logger.info(f"{ex}")
+        except Exception as ex:
+            logger.warning(f"Поиск в локальной копии папки {folder}: {ex}")
+
+    tokens = get_criteria_tokens(criteria)
+    if state and tokens and all(token_index.is_token(x) for x in tokens):
+        uids = await asyncio.to_thread(
+            token_index.lookup,
+            tokens,
+            folder,
+            state.get("uidvalidity"),
+            state.get("uidnext"),
+            get_date_begin(),
+        )
+        if uids is not None:
+            return uids
+
+    date_begin = get_date_begin()
+    cached, since = await asyncio.to_thread(
+        search_cache.get, criteria, folder, state, date_begin
+    )
+    if cached is not None and since is None:
+        return cached
+
+    args = ["UID", f"{since}:*"] if since else []
+    args += ["SENTSINCE", date_begin.strftime("%d-%b-%Y")]
+    args += text_search_args(tokens)
+    async with pooled_connection_async(folder) as session:
+        response = await session.imap.uid_search(*args)
+    if response.result != "OK" or not response.lines:
+        return []
+    uids = [x for x in bytes(response.lines[0]).split() if x.isdigit()]
+    if since:
+        uids = search_cache.merge(cached, uids, since)
+    await asyncio.to_thread(search_cache.put, criteria, folder, state, date_begin, uids)
+    return uids
+
+
+async def read_messages_async(ids: List[bytes], folder: str, criteria: str = ""):
+    """Выборка данных пакета сообщений (см. emessages.read_messages).
+    Разбор ответов - после возврата соединения в пул"""
+    texts = []
+    async with pooled_connection_async(folder) as session:
+        uidvalidity = session.uidvalidity
+        results, ids = lookup_parsed(ids, folder, uidvalidity, criteria)
+        if not ids:
+            return results
+        if app.config.IMAP_FETCH.MODE == "full":
+            data = await uid_fetch_async(session, ids, "(UID RFC822)", True)
+        else:
+            data = await uid_fetch_async(session, ids, LISTING_ITEMS, True)
+            fetched, sections = parse_listing(data, folder, criteria)
+            for section, parts in sections.items():
+                data = await uid_fetch_async(
+                    session, [id for id, _ in parts], f"(UID BODY.PEEK[{section}])"
+                )
+                texts.append((parts, data, section))
+    if app.config.IMAP_FETCH.MODE == "full":
+        fetched, parts = await asyncio.to_thread(
+            parse_messages, data, ids, folder, criteria
+        )
+        await asyncio.to_thread(set_message_text, fetched, parts)
+    for parts, data, section in texts:
+        await asyncio.to_thread(set_listing_text, fetched, parts, data, section)
+    store_parsed(fetched, folder, uidvalidity, criteria)
+    return results | fetched
+
+
+def lookup_cached(ids: List[bytes], folder: str, criteria: str):
+    found = get_message_data.lookup_many([(id, folder, criteria) for id in ids])
+    return {id: result for id, (hit, result) in zip(ids, found) if hit}
+
+
+def store_cached(results: dict, folder: str, criteria: str):
+    get_message_data.store_many(
+        [
+            ((id, folder, criteria), result)
+            for id, result in results.items()
+            if not (result and result.error)
+        ]
+    )
+
+
+async def get_many_async(cached, args_list: list, compute) -> dict:
+    """Асинхронный аналог get_many кеша cached (см. redis_cache): compute -
+    корутина, ожидание блокировок - в цикле событий, в потоках выполняются
+    только команды Redis"""
+    values = {}
+    pending = list(args_list)
+    deadline = time.monotonic() + app.config.REDIS.LOCK_SECONDS
+    while pending:
+        found = await asyncio.to_thread(cached.lookup_many, pending, True)
+        for args, (hit, result) in zip(pending, found):
+            if hit:
+                values[args] = result
+        pending = [args for args in pending if args not in values]
+        if not pending:
+            break
+        tokens = await asyncio.to_thread(cached.acquire_many, pending)
+        owned = [args for args in pending if args in tokens]
+        if not owned and time.monotonic() > deadline:
+            owned = pending
+        if owned:
+            try:
+                try:
+                    computed = await compute(owned)
+                except Exception as ex:
+                    logger.error(f"{ex}")
+                    computed = {args: ex for args in owned}
+                values.update(
+                    await asyncio.to_thread(cached.settle_many, owned, computed)
+                )
+            finally:
+                await asyncio.to_thread(cached.release_many, tokens)
+            pending = [args for args in pending if args not in values]
+            continue
+        await asyncio.sleep(app.config.REDIS.LOCK_POLL_SECONDS)
+    return values
+
+
+async def read_messages_cached_async(
+    ids: List[bytes], folder: str, criteria: str = "", semaphore=None
+) -> dict:
+    """Данные писем из кеша, отсутствующие выбираются с сервера пакетами
+    (одни и те же письма выбирает только один запрос, см.
+    emessages.read_messages_cached). Ошибки - результаты с error"""
+    semaphore = semaphore or asyncio.Semaphore(app.config.IMAP_ASYNC.CONCURRENCY)
+
+    async def fetch_batch(batch: List[bytes]) -> dict:
+        async with semaphore:
+            results = await read_messages_async(batch, folder, criteria)
+        # письма, которых нет в ответе FETCH, отсутствуют в папке
+        results = {id: results.get(id) for id in batch}
+        await asyncio.to_thread(store_cached, results, folder, criteria)
+        return results
+
+    async def fetch(keys: list) -> dict:
+        values = {}
+        parts = batches([id for id, _, _ in keys], app.config.IMAP_FETCH.BATCH_SIZE)
+        fetched = await asyncio.gather(
+            *[fetch_batch(batch) for batch in parts], return_exceptions=True
+        )
+        for batch, results in zip(parts, fetched):
+            if isinstance(results, Exception):
+                for id in batch:
+                    values[(id, folder, criteria)] = results
+                continue
+            for id, result in results.items():
+                values[(id, folder, criteria)] = (
+                    CachedFailure(result.error) if result and result.error else result
+                )
+        return values
+
+    values = await get_many_async(
+        get_message_data, [(id, folder, criteria) for id in ids], fetch
+    )
+    return {
+        id: Result(error_message=f"{value}")
+        if isinstance(value, CachedFailure)
+        else value
+        for (id, _, _), value in values.items()
+    }
+
+
+async def process_folder_async(criteria: str, folder: str, semaphore):
+    """Обработка одной папки: поиск и выборка писем пакетами
+    с ограничением числа одновременных команд FETCH"""
+    folder_results = []
+    folder_errors = []
+    async with pooled_connection_async(folder) as session:
+        state = await folder_status_async(session, folder)
+    uids = await search_messages_async(criteria, folder, state)
+    results = await read_messages_cached_async(uids[:100], folder, criteria, semaphore)
+    for result in results.values():
+        if result and result.error:
+            folder_errors.append(result)
+        elif result:
+            folder_results.append(result)
+
+    uidvalidity = state.get("uidvalidity")
+    tokens = get_criteria_tokens(criteria)
+    single = len(tokens) == 1 and token_index.is_token(tokens[0])
+    await asyncio.to_thread(
+        uid_index.remember, folder, uidvalidity, [x.id for x in folder_results]
+    )
+    await asyncio.to_thread(
+        token_index.add,
+        folder,
+        uidvalidity,
+        folder_results,
+        tokens if single else (),
+    )
+    if single and len(uids) <= 100 and not folder_errors:
+        await asyncio.to_thread(
+            token_index.cover, tokens[0], folder, uidvalidity, state.get("uidnext")
+        )
+    return folder_results, folder_errors
+
+
+async def fetch_messages_async(criteria: str, folders) -> List:
+    """Поиск писем одновременно во всех папках"""
+    results = []
+    error_results = []
+    semaphore = asyncio.Semaphore(app.config.IMAP_ASYNC.CONCURRENCY)
+    folder_results = await asyncio.gather(
+        *[process_folder_async(criteria, folder, semaphore) for folder in folders],
+        return_exceptions=True,
+    )
+    for data in folder_results:
+        if isinstance(data, Exception):
+            logger.error(f"Ошибка обработки папки: {data}")
+            error_results.append(Result(error_message=f"Ошибка папки: {data}"))
+        else:
+            results += data[0]
+            error_results += data[1]
+
+    try:
+        results = sorted([x for x in results if x], key=lambda x: x.date, reverse=True)
+        return results + error_results
+    except Exception as ex:
+        logger.error(f"{ex}")
+        return error_results
+
+
+async def get_results_async(handles: list, criteria: str) -> list:
+    """Результаты по ссылкам курсора (см. emessages.get_results)"""
+    folders = {}
+    for handle in handles:
+        if "id" in handle:
+            folders.setdefault(handle["path"], []).append(handle["id"].encode())
+
+    async def read_folder(folder: str, ids: List[bytes]):
+        results = await read_messages_cached_async(ids, folder, criteria)
+        return {(folder, id): result for id, result in results.items()}
+
+    found = {}
+    for data in await asyncio.gather(
+        *[read_folder(folder, ids) for folder, ids in folders.items()]
+    ):
+        found |= data
+    results = []
+    for handle in handles:
+        if "id" in handle:
+            result = found.get((handle["path"], handle["id"].encode()))
+            if result:
+                results.append(result)
+        else:
+            results.append(Result(error_message=handle["error"]))
+    return results
+
+
+async def get_message_folders_async(id: bytes, folders) -> List[str]:
+    """Папки для выборки письма id (см. emessages.get_message_folders)"""
+    folders = list(folders)
+    known = {}
+    if len(folders) > 1:
+        known = await asyncio.to_thread(uid_index.lookup, id, folders)
+    if len(known) < len(folders):
+        return folders
+    indexed = []
+    for folder, (uidvalidity, found) in known.items():
+        try:
+            async with pooled_connection_async(folder) as session:
+                current = session.uidvalidity
+        except Exception as ex:
+            logger.warning(f"{ex}")
+            current = None
+        if uidvalidity != current:
+            await asyncio.to_thread(uid_index.forget, id, folder)
+            return folders
+        if found:
+            indexed.append(folder)
+    return indexed
+
+
+async def remember_message_folder_async(id: bytes, folder: str, result):
+    """Запомнить в индексе UID, есть ли письмо id в папке
+    (см. emessages.remember_message_folder)"""
+    async with pooled_connection_async(folder) as session:
+        uidvalidity = session.uidvalidity
+        if result is None:
+            state = await folder_status_async(session, folder)
+            if int(id) >= (state.get("uidnext") or 0):
+                return
+            uidvalidity = state.get("uidvalidity")
+    await asyncio.to_thread(
+        uid_index.remember, folder, uidvalidity, [id], result is not None
+    )
+
+
+async def get_message_data_async(id: bytes, folder: str):
+    cached = await asyncio.to_thread(lookup_cached, [id], folder, "")
+    if id in cached:
+        return cached[id]
+    results = await read_messages_async([id], folder)
+    result = results.get(id)
+    if result and result.error:
+        raise DataIsNotFound(result.error)
+    await asyncio.to_thread(store_cached, {id: result}, folder, "")
+    return result
+
+
+async def fetch_message_async(id: bytes, folders) -> List:
+    """Выборка сообщения по идентификатору"""
+    folders = await get_message_folders_async(id, folders)
+    results = await asyncio.gather(
+        *[get_message_data_async(id, folder) for folder in folders]
+    )
+    for folder, result in zip(folders, results):
+        await remember_message_folder_async(id, folder, result)
+    return [x for x in results if x]
+
+
+async def download_section_async(
+    session: AsyncSession, id: bytes, part: dict, filename
+):
+    """Загрузка секции письма частями с потоковым декодированием в файл"""
+    decoder = PayloadDecoder(part["encoding"])
+    offset = 0
+    with open(filename, mode="wb") as f:
+        while True:
+            data = await uid_fetch_async(
+                session, [id], section_chunk_items(part, offset)
+            )
+            chunk = get_section_chunk(data, id, part)
+            f.write(decoder.feed(chunk))
+            offset += len(chunk)
+            if len(chunk) < app.config.IMAP_FETCH.CHUNK_SIZE:
+                break
+        f.write(decoder.flush())
+
+
+async def get_attachments_async(id: bytes, folder: str, att_id: str = ""):
+    async with pooled_connection_async(folder) as session:
+        if app.config.IMAP_FETCH.MODE == "full":
+            data = await uid_fetch_async(session, [id], "(UID RFC822)")
+            items = parse_fetch(data).get(int(id), {})
+            if not items.get("RFC822"):
+                return None
+            msg = await asyncio.to_thread(email.message_from_bytes, items["RFC822"])
+            return await asyncio.to_thread(extract_attachments, msg, att_id)
+
+        data = await uid_fetch_async(session, [id], "(UID BODYSTRUCTURE)")
+        selected = select_attachment_parts(parse_fetch(data).get(int(id), {}), att_id)
+        if not selected:
+            return None
+        if blob_cache.enabled():
+            blobs = []
+            for file, part in selected:
+                key = (folder, session.uidvalidity, id.decode(), part["section"])
+                blob = await asyncio.to_thread(blob_cache.get, key)
+                if blob is None:
+                    staging = blob_cache.staging_path()
+                    try:
+                        await download_section_async(session, id, part, staging)
+                        blob = await asyncio.to_thread(
+                            cache_attachment, key, staging, file["name"]
+                        )
+                    finally:
+                        staging.unlink(missing_ok=True)
+                blobs.append(blob)
+            return await asyncio.to_thread(get_cached_attachments, blobs)
+
+        files = []
+        path = get_output_path()
+        for file, part in selected:
+            filename = unique_name(file["name"], files)
+            await download_section_async(session, id, part, Path(path, filename))
+            files.append(filename)
+    return make_archive(path, files) if len(files) > 1 else Path(path, files[0])
+
+
+async def fetch_attachments_async(id: bytes, folders, att_id: str = ""):
+    """Получить вложения письма"""
+    folders = await get_message_folders_async(id, folders)
+    for filename in await asyncio.gather(
+        *[get_attachments_async(id, folder, att_id) for folder in folders]
+    ):
+        if filename:
+            return filename
+    return None
+
+
+if __name__ == "__main__":
+    pass
@@ -28,3 +28,14 @@ class ConnectionErrorException(Exception):
     def __init__(self, name:str=""):
         self._message = "Ошибка соединения с сервером {}".format(name)
         super(ConnectionErrorException, self).__init__(self._message)
+
+class CachedFailure(Exception):
+    """Ошибка вычисления значения, кратковременно сохраненная в кеше"""
+    def __init__(self, message: str = ""):
+        self._message = message
+        super(CachedFailure, self).__init__(self._message)
+
+class MirrorIsNotReady(Exception):
+    def __init__(self, folder: str = ""):
+        self._message = f"Локальная копия папки {folder} не синхронизирована"
+        super(MirrorIsNotReady, self).__init__(self._message)
@@ -1,5 +1,6 @@
-import os, uuid, zipfile, logging, quopri, json, re
+import os, uuid, zipfile, logging, quopri, json, re, base64
 from datetime import datetime
+from html.parser import HTMLParser
 from pathlib import Path
 from src import app
 
@@ -47,7 +48,108 @@ def make_archive(path, files: list) -> str:
     return arch_name if Path.exists(arch_name) else None
 
 
-def decode_quoted_printable(contents) -> str:
-    text = quopri.decodestring(bytes(contents, "utf-8"))
-    text = text.decode("utf-8")
-    return text
+_NEWLINES = re.compile(r"(\n)+")
+
+
+class HtmlText(HTMLParser):
+    """Потоковое извлечение текста из HTML (без построения дерева)"""
+
+    SKIP = {"script", "style"}
+    BLOCK = {"br", "p", "div", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "table"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skip += 1
+        elif tag in self.BLOCK:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self.skip = max(self.skip - 1, 0)
+        elif tag in self.BLOCK:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.parts.append(data)
+
+
+def html_to_text(contents: str) -> str:
+    parser = HtmlText()
+    parser.feed(contents)
+    parser.close()
+    return _NEWLINES.sub("\n", "".join(parser.parts))
+
+
+def part_to_text(contents: str, content_type: str) -> str:
+    """Текст части письма: HTML преобразуется, простой текст - как есть"""
+    if content_type == "text/html":
+        return html_to_text(contents)
+    return _NEWLINES.sub("\n", contents)
+
+
+def decode_payload(payload: bytes, encoding: str = "", charset: str = "") -> str:
+    """Декодирование содержимого части письма по Content-Transfer-Encoding
+    и кодировке символов части"""
+    encoding = (encoding or "").lower()
+    if encoding == "base64":
+        payload = base64.b64decode(payload)
+    elif encoding == "quoted-printable":
+        payload = quopri.decodestring(payload)
+    try:
+        return payload.decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        return payload.decode("utf-8", errors="replace")
+
+
+class PayloadDecoder:
+    """Потоковое декодирование Content-Transfer-Encoding по частям"""
+
+    def __init__(self, encoding: str = ""):
+        self.encoding = (encoding or "").lower()
+        self.buffer = b""
+
+    def feed(self, chunk: bytes) -> bytes:
+        if self.encoding == "base64":
+            self.buffer += re.sub(rb"[^A-Za-z0-9+/=]", b"", chunk)
+            size = len(self.buffer) // 4 * 4
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return base64.b64decode(data)
+        if self.encoding == "quoted-printable":
+            self.buffer += chunk
+            size = self.buffer.rfind(b"\n") + 1
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return quopri.decodestring(data)
+        return chunk
+
+    def flush(self) -> bytes:
+        data, self.buffer = self.buffer, b""
+        if not data:
+            return b""
+        if self.encoding == "base64":
+            return base64.b64decode(data + b"=" * (-len(data) % 4))
+        return quopri.decodestring(data)
+
+
+def safe_file_name(name: str) -> str:
+    """Имя файла из заголовков письма без каталогов ("../", "/etc/", "C:\\").
+    Пустая строка, если имени не остается"""
+    name = Path((name or "").replace("\\", "/")).name.strip()
+    return "" if name in (".", "..") else name
+
+
+def unique_name(name: str, names) -> str:
+    """Имя файла, не совпадающее с уже занятыми names"""
+    name = safe_file_name(name) or "attachment"
+    if name not in names:
+        return name
+    path = Path(name)
+    n = 2
+    while f"{path.stem} ({n}){path.suffix}" in names:
+        n += 1
+    return f"{path.stem} ({n}){path.suffix}"
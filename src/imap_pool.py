@@ -0,0 +1,273 @@
+import os
+import re
+import time
+import imaplib
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from src import app
+from .exceptions import *
+
+logger = logging.getLogger(__name__)
+
+
+def login():
+    """Открыть авторизованную сессию IMAP (без выбранной папки)"""
+    try:
+        imap = imaplib.IMAP4_SSL(
+            host=app.config.IMAP_SERVER.host,
+            port=app.config.IMAP_SERVER.port,
+            timeout=30,
+        )
+    except Exception as ex:
+        logger.error(f"{ex}")
+        raise ConnectionErrorException(ex)
+
+    try:
+        imap.login(app.config.IMAP_SERVER.user, app.config.IMAP_SERVER.password)
+    except Exception as ex:
+        logger.error(f"{ex}")
+        logout(imap)
+        raise AccessDeniedException()
+    return imap
+
+
+def select(imap, folder: str) -> int:
+    """Выбрать папку, возвращает UIDVALIDITY папки"""
+    status, _ = imap.select(folder)
+    if status == "OK":
+        _, data = imap.response("UIDVALIDITY")
+        return int(data[0]) if data and data[0] else 0
+
+    folders = ""
+    try:
+        status, folders = imap.list()
+        if folders:
+            folders = "".join([x.decode("utf-8") for x in folders]).strip("'") + "("
+            folders = ",".join(
+                re.findall(r"(?<=\s)[A-Za-zА-Яа-я-\s]{2,}(?=\()", folders)
+            )
+    finally:
+        raise InboxIsNotSelected(f"{folder}. Список доступных папок: {folders}")
+
+
+def logout(imap):
+    try:
+        imap.logout()
+    except Exception as ex:
+        logger.debug(f"{ex}")
+
+
+class PooledSession:
+    """Сессия пула: соединение IMAP и его состояние.
+    folder = None - сессия авторизована, но папка не выбрана
+    """
+
+    def __init__(self, imap, folder: str = None, uidvalidity: int = 0):
+        self.imap = imap
+        self.folder = folder
+        self.uidvalidity = uidvalidity
+        self.created = time.monotonic()
+        self.used = self.created
+        self.checked = self.created
+
+
+class ConnectionPool:
+    """Пул авторизованных IMAP-сессий воркера, сгруппированных по выбранной папке.
+    Размер пула ограничен max_size, простаивающие дольше max_idle и
+    живущие дольше max_lifetime сессии закрываются, перед выдачей
+    давно не проверявшейся сессии выполняется NOOP.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 16,
+        max_idle: float = 300,
+        max_lifetime: float = 1800,
+        noop_interval: float = 30,
+        timeout: float = 30,
+    ):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.noop_interval = noop_interval
+        self.timeout = timeout
+        self._idle = {}
+        self._size = 0
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+
+    def acquire(self, folder: str) -> PooledSession:
+        deadline = time.monotonic() + self.timeout
+        while True:
+            session = self._take(folder, deadline)
+            if session is None:
+                return self._open(folder)
+            if self._expired(session) or not self._alive(session):
+                # место в пуле остается за новой сессией
+                logout(session.imap)
+                return self._open(folder)
+            if session.folder != folder:
+                try:
+                    session.folder = None
+                    session.uidvalidity = select(session.imap, folder)
+                    session.folder = folder
+                except InboxIsNotSelected:
+                    self.release(session)
+                    raise
+                except Exception:
+                    self._close(session)
+                    raise
+            return session
+
+    def release(self, session: PooledSession, broken: bool = False):
+        if broken or self._expired(session):
+            self._close(session)
+            return
+        session.used = time.monotonic()
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._idle.setdefault(session.folder, deque()).append(session)
+            self._cond.notify()
+        self._sweep()
+
+    def in_use(self) -> int:
+        """Количество выданных сессий"""
+        with self._cond:
+            return self._size - sum(len(idle) for idle in self._idle.values())
+
+    def clear(self):
+        with self._cond:
+            sessions = [s for idle in self._idle.values() for s in idle]
+            self._idle.clear()
+        for session in sessions:
+            self._close(session)
+
+    def _take(self, folder: str, deadline: float):
+        """Свободная сессия (своей папки, затем любой) или None,
+        если разрешено открыть новую. Ожидает, если пул исчерпан."""
+        with self._cond:
+            self._check_pid()
+            while True:
+                idle = self._idle.get(folder)
+                if idle:
+                    return idle.pop()
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None
+                for idle in self._idle.values():
+                    if idle:
+                        return idle.pop()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ConnectionErrorException("(пул IMAP-соединений исчерпан)")
+                self._cond.wait(remaining)
+
+    def _open(self, folder: str) -> PooledSession:
+        """Открыть новую сессию на уже зарезервированное место в пуле"""
+        try:
+            imap = login()
+        except Exception:
+            self._free()
+            raise
+        session = PooledSession(imap)
+        try:
+            session.uidvalidity = select(imap, folder)
+            session.folder = folder
+        except InboxIsNotSelected:
+            self.release(session)
+            raise
+        except Exception:
+            self._close(session)
+            raise
+        return session
+
+    def _alive(self, session: PooledSession) -> bool:
+        now = time.monotonic()
+        if now - session.checked < self.noop_interval:
+            return True
+        try:
+            status, _ = session.imap.noop()
+        except Exception as ex:
+            logger.debug(f"{ex}")
+            return False
+        session.checked = now
+        return status == "OK"
+
+    def _expired(self, session: PooledSession) -> bool:
+        now = time.monotonic()
+        return (
+            now - session.created > self.max_lifetime
+            or now - session.used > self.max_idle
+        )
+
+    def _sweep(self):
+        expired = []
+        with self._cond:
+            for idle in self._idle.values():
+                while idle and self._expired(idle[0]):
+                    expired.append(idle.popleft())
+        for session in expired:
+            self._close(session)
+
+    def _close(self, session: PooledSession):
+        logout(session.imap)
+        self._free()
+
+    def _free(self):
+        with self._cond:
+            if self._size > 0:
+                self._size -= 1
+            self._cond.notify()
+
+    def _check_pid(self):
+        # после fork сокеты принадлежат родительскому процессу
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = {}
+            self._size = 0
+
+
+pool = ConnectionPool(
+    max_size=app.config.IMAP_POOL.MAX_SIZE,
+    max_idle=app.config.IMAP_POOL.MAX_IDLE_SECONDS,
+    max_lifetime=app.config.IMAP_POOL.MAX_LIFETIME_SECONDS,
+    noop_interval=app.config.IMAP_POOL.NOOP_INTERVAL_SECONDS,
+    timeout=app.config.IMAP_POOL.ACQUIRE_TIMEOUT_SECONDS,
+)
+
+
+@contextmanager
+def pooled_connection(folder: str):
+    """Сессия из пула с выбранной папкой folder.
+    При обрыве соединения сессия закрывается, иначе возвращается в пул
+    """
+    session = pool.acquire(folder)
+    try:
+        yield session
+    except (imaplib.IMAP4.abort, OSError):
+        pool.release(session, broken=True)
+        raise
+    except BaseException:
+        pool.release(session)
+        raise
+    else:
+        pool.release(session)
+
+
+def status(imap, folder: str) -> dict:
+    """Состояние папки по ответу SELECT: messages, uidnext, uidvalidity
+    и highestmodseq (если сервер его сообщает). Сессии пула выбирают папку,
+    а STATUS для выбранной папки не используется (RFC 3501, 6.3.10):
+    сервер может вернуть устаревший UIDNEXT"""
+    typ, data = imap.select(folder)
+    if typ != "OK":
+        raise InboxIsNotSelected(folder)
+    state = {"messages": int(data[0])} if data and data[0] else {}
+    for key in ("UIDNEXT", "UIDVALIDITY", "HIGHESTMODSEQ"):
+        _, value = imap.response(key)
+        if value and value[-1]:
+            state[key.lower()] = int(value[-1])
+    return state
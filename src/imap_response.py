@@ -0,0 +1,204 @@
+"""Разбор ответов IMAP-сервера на команду (UID) FETCH и BODYSTRUCTURE,
+формирование наборов UID (sequence set) для пакетных запросов"""
+import re
+from urllib.parse import unquote
+from typing import Dict, Iterable, List
+
+_LITERAL = re.compile(rb"\{(\d+)\}$")
+_SPECIALS = b" ()\""
+
+
+class _Literal(bytes):
+    pass
+
+
+def sequence_set(uids: Iterable) -> str:
+    """Список UID -> набор вида 101,105,110:118"""
+    numbers = sorted({int(x) for x in uids})
+    ranges = []
+    for number in numbers:
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ",".join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+
+def batches(items: list, size: int) -> List[list]:
+    size = max(int(size), 1)
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def _tokenize(data: list):
+    """Лексемы ответа: '(' ')' атомы, строки, литералы.
+    data - ответ imaplib: строки bytes и пары (строка, литерал)"""
+    for item in data:
+        if isinstance(item, tuple):
+            line, literal = item
+        else:
+            line, literal = item, None
+        if line is None:
+            continue
+        tail = _LITERAL.search(line) if literal is not None else None
+        if tail:
+            line = line[: tail.start()]
+        yield from _tokenize_line(line)
+        if literal is not None:
+            yield _Literal(literal)
+
+
+def _tokenize_line(line: bytes):
+    i, n = 0, len(line)
+    while i < n:
+        c = line[i : i + 1]
+        if c == b" ":
+            i += 1
+        elif c in (b"(", b")"):
+            yield c
+            i += 1
+        elif c == b'"':
+            i += 1
+            value = bytearray()
+            while i < n and line[i : i + 1] != b'"':
+                if line[i : i + 1] == b"\\":
+                    i += 1
+                value += line[i : i + 1]
+                i += 1
+            yield _Literal(bytes(value))
+            i += 1
+        else:
+            start, depth = i, 0
+            while i < n:
+                c = line[i : i + 1]
+                if c == b"[":
+                    depth += 1
+                elif c == b"]":
+                    depth -= 1
+                elif depth == 0 and c in _SPECIALS:
+                    break
+                i += 1
+            atom = line[start:i]
+            yield None if atom.upper() == b"NIL" else atom
+
+
+def _parse_list(tokens) -> list:
+    values = []
+    for token in tokens:
+        if token == b")" and not isinstance(token, _Literal):
+            return values
+        if token == b"(" and not isinstance(token, _Literal):
+            values.append(_parse_list(tokens))
+        else:
+            values.append(bytes(token) if isinstance(token, _Literal) else token)
+    return values
+
+
+def parse_fetch(data: list) -> Dict[int, dict]:
+    """Ответ FETCH -> {uid: {элемент: значение}}
+    Литералы и строки возвращаются как bytes, NIL как None,
+    вложенные списки (BODYSTRUCTURE, ENVELOPE) как list"""
+    messages = {}
+    tokens = _tokenize(data or [])
+    for token in tokens:
+        if token != b"(" or isinstance(token, _Literal):
+            continue
+        values = _parse_list(tokens)
+        items = {}
+        for i in range(0, len(values) - 1, 2):
+            key = values[i]
+            if isinstance(key, bytes):
+                items[key.decode("ascii", "replace").upper()] = values[i + 1]
+        uid = items.get("UID")
+        if uid is None:
+            continue
+        uid = int(uid)
+        messages.setdefault(uid, {}).update(items)
+    return messages
+
+
+def _text(value) -> str:
+    return value.decode("utf-8", "replace") if isinstance(value, bytes) else ""
+
+
+def _params(values) -> dict:
+    if not isinstance(values, list):
+        return {}
+    return {
+        _text(values[i]).lower(): _text(values[i + 1])
+        for i in range(0, len(values) - 1, 2)
+    }
+
+
+def body_parts(structure: list, section: str = "") -> List[dict]:
+    """BODYSTRUCTURE -> список частей письма с номерами секций IMAP:
+    section, type, params, encoding, size, disposition, disposition_params"""
+    if not isinstance(structure, list) or not structure:
+        return []
+    parts = []
+    if isinstance(structure[0], list):
+        # multipart: вложенные части идут первыми, затем подтип
+        for n, child in enumerate(structure, 1):
+            if not isinstance(child, list):
+                break
+            parts += body_parts(child, f"{section}.{n}" if section else str(n))
+        return parts
+
+    section = section or "1"
+    maintype = _text(structure[0]).lower()
+    subtype = _text(structure[1]).lower() if len(structure) > 1 else ""
+    size = structure[6] if len(structure) > 6 else None
+    ext = 7
+    if maintype == "text":
+        ext = 8
+    elif maintype == "message" and subtype == "rfc822":
+        ext = 10
+    disposition = structure[ext + 1] if len(structure) > ext + 1 else None
+    if not isinstance(disposition, list) or not disposition:
+        disposition = [None, None]
+    part = {
+        "section": section,
+        "type": f"{maintype}/{subtype}",
+        "params": _params(structure[2] if len(structure) > 2 else None),
+        "encoding": _text(structure[5] if len(structure) > 5 else None).lower(),
+        "size": int(size) if isinstance(size, bytes) and size.isdigit() else 0,
+        "disposition": _text(disposition[0]).lower() or None,
+        "disposition_params": _params(disposition[1] if len(disposition) > 1 else None),
+    }
+    body = structure[8] if ext == 10 and len(structure) > 8 else None
+    if part["disposition"] != "attachment" and isinstance(body, list) and body:
+        # вложенное письмо: части нумеруются внутри его секции
+        if isinstance(body[0], list):
+            return body_parts(body, section)
+        return body_parts(body, f"{section}.1")
+    return [part]
+
+
+def part_filename(part: dict) -> str:
+    """Имя файла части (параметр filename или name), с учетом
+    продолжений и кодировки по RFC 2231"""
+    for params, name in (
+        (part["disposition_params"], "filename"),
+        (part["params"], "name"),
+    ):
+        if name in params:
+            return params[name]
+        chunks = sorted(
+            [(key, value) for key, value in params.items() if key.startswith(f"{name}*")],
+            key=lambda x: _chunk_number(x[0], name),
+        )
+        if not chunks:
+            continue
+        value = "".join(v for _, v in chunks)
+        if chunks[0][0].endswith("*") and value.count("'") >= 2:
+            charset, _, value = value.split("'", 2)
+            try:
+                return unquote(value, encoding=charset or "utf-8", errors="replace")
+            except LookupError:
+                return unquote(value, errors="replace")
+        return value
+    return ""
+
+
+def _chunk_number(key: str, name: str) -> int:
+    number = key[len(name) + 1 :].rstrip("*")
+    return int(number) if number.isdigit() else 0
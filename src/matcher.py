@@ -0,0 +1,75 @@
+from collections import deque
+from functools import lru_cache
+from typing import Iterable, List, Tuple
+
+
+class Matcher:
+    """Поиск нескольких строк (ИНН, ОГРН) в тексте за один проход
+    (автомат Ахо-Корасик). Регистр букв не учитывается"""
+
+    def __init__(self, terms: Iterable[str]):
+        self.terms = []
+        # переходы, ссылки на суффиксы и найденные строки для каждого состояния
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for term in terms:
+            term = term.strip()
+            if term and term not in self.terms:
+                self.terms.append(term)
+                self._add(term)
+        self._build()
+
+    def _add(self, term: str):
+        state = 0
+        for ch in term.lower():
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = next_state
+        self._out[state].append((term, len(term)))
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                self._out[next_state] = (
+                    self._out[next_state] + self._out[self._fail[next_state]]
+                )
+
+    def search(self, text: str) -> List[Tuple[str, int, int]]:
+        """Все вхождения строк в текст: [(строка, начало, конец)]"""
+        found = []
+        if not self.terms or not text:
+            return found
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for i, ch in enumerate(text):
+            ch = ch.lower()
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for term, size in out[state]:
+                found.append((term, i + 1 - size, i + 1))
+        found.sort(key=lambda x: x[1])
+        return found
+
+    def found(self, *texts: str) -> set:
+        """Строки, найденные хотя бы в одном из текстов"""
+        return {term for text in texts for term, _, _ in self.search(text)}
+
+
+@lru_cache(maxsize=1024)
+def criteria_matcher(criteria: str) -> Matcher:
+    """Автомат для критерия поиска "ИНН,ОГРН" (общий для всех писем запроса)"""
+    return Matcher(criteria.split(","))
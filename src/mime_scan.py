@@ -0,0 +1,99 @@
+"""Потоковый разбор письма RFC822 для списка писем.
+Разбираются только заголовки частей, границы multipart находятся
+поиском по исходным байтам: содержимое вложений не копируется и не
+декодируется, сохраняется только содержимое текстовых частей.
+Номера частей совпадают с номерами секций IMAP"""
+from email.message import Message
+from email.parser import BytesHeaderParser
+from typing import List, Tuple
+
+_parser = BytesHeaderParser()
+
+
+def scan(raw: bytes) -> Tuple[Message, List[dict]]:
+    """Письмо -> (заголовки, части): section, type, charset, encoding,
+    size, disposition, filename и payload (только для текстовых частей)"""
+    headers, body = _headers(raw, 0, len(raw))
+    parts = []
+    _scan(raw, body, len(raw), headers, "", parts)
+    return headers, parts
+
+
+def _headers(raw: bytes, start: int, end: int) -> Tuple[Message, int]:
+    """Заголовки части и начало ее содержимого"""
+    if raw.startswith(b"\r\n", start):
+        return Message(), start + 2
+    if raw.startswith(b"\n", start):
+        return Message(), start + 1
+    candidates = [
+        (i, i + len(sep))
+        for sep in (b"\r\n\r\n", b"\n\n")
+        for i in (raw.find(sep, start, end),)
+        if i != -1
+    ]
+    if not candidates:
+        return _parser.parsebytes(raw[start:end]), end
+    header_end, body = min(candidates)
+    return _parser.parsebytes(raw[start:header_end]), body
+
+
+def _scan(raw: bytes, start: int, end: int, headers, section: str, parts: list):
+    content_type = headers.get_content_type()
+    disposition = headers.get_content_disposition()
+    boundary = None
+    if headers.get_content_maintype() == "multipart":
+        boundary = headers.get_boundary()
+    if boundary:
+        for n, (s, e) in enumerate(_split(raw, start, end, boundary.encode()), 1):
+            child, body = _headers(raw, s, e)
+            _scan(raw, body, e, child, f"{section}.{n}" if section else str(n), parts)
+        return
+    if content_type == "message/rfc822" and section and disposition != "attachment":
+        inner, body = _headers(raw, start, end)
+        if inner.get_content_maintype() == "multipart":
+            _scan(raw, body, end, inner, section, parts)
+        else:
+            _scan(raw, body, end, inner, f"{section}.1", parts)
+        return
+
+    part = {
+        "section": section or "1",
+        "type": content_type,
+        "charset": headers.get_content_charset(),
+        "encoding": (headers.get("Content-Transfer-Encoding") or "").strip().lower(),
+        "size": end - start,
+        "disposition": disposition,
+        "filename": headers.get_filename() or "",
+        "payload": None,
+    }
+    if disposition != "attachment" and headers.get_content_maintype() == "text":
+        part["payload"] = raw[start:end]
+    parts.append(part)
+
+
+def _split(raw: bytes, start: int, end: int, boundary: bytes):
+    """Границы вложенных частей multipart: [(начало, конец)]"""
+    delimiter = b"--" + boundary
+
+    def find(position: int) -> int:
+        i = raw.find(delimiter, position, end)
+        while i > start and raw[i - 1] != 0x0A:  # разделитель - с начала строки
+            i = raw.find(delimiter, i + 1, end)
+        return i
+
+    i = find(start)
+    while i != -1:
+        after = i + len(delimiter)
+        if raw.startswith(b"--", after):
+            return
+        line_end = raw.find(b"\n", after, end)
+        if line_end == -1:
+            return
+        s = line_end + 1
+        j = find(s)
+        e = j if j != -1 else end
+        if j != -1:
+            # перевод строки перед разделителем относится к разделителю
+            e -= 2 if raw[e - 2 : e] == b"\r\n" else 1
+        yield s, max(e, s)
+        i = j
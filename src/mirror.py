@@ -0,0 +1,268 @@
+"""Локальная копия почтового ящика в SQLite (FTS5) для поиска писем по ИНН/ОГРН.
+Синхронизация инкрементальная: по UIDVALIDITY, UIDNEXT и HIGHESTMODSEQ
+(CONDSTORE) с сервера загружаются только новые письма"""
+import json
+import time
+import sqlite3
+import logging
+import datetime
+import threading
+from pathlib import Path
+from typing import Callable, List
+from src import app
+from src.imap_pool import pooled_connection, status
+from src.imap_response import batches
+from src.exceptions import MirrorIsNotReady
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    folder TEXT PRIMARY KEY,
+    uidvalidity INTEGER,
+    uidnext INTEGER,
+    messages INTEGER,
+    highestmodseq INTEGER,
+    synced REAL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    folder TEXT,
+    uid INTEGER,
+    date REAL,
+    sender TEXT,
+    subject TEXT,
+    files TEXT,
+    UNIQUE (folder, uid)
+);
+"""
+
+_local = threading.local()
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return bool(app.config.get("MIRROR") and app.config.MIRROR.ENABLED)
+
+
+def _connect() -> sqlite3.Connection:
+    db = getattr(_local, "db", None)
+    if db is None:
+        path = Path(app.config.MIRROR.PATH)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+        try:
+            db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts "
+                "USING fts5(text, tokenize='trigram')"
+            )
+        except sqlite3.OperationalError:
+            # SQLite < 3.34: поиск по словам вместо подстрок
+            db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text)"
+            )
+        _local.db = db
+    return db
+
+
+def _folder_lock(folder: str) -> threading.Lock:
+    with _locks_lock:
+        return _locks.setdefault(folder, threading.Lock())
+
+
+def _date_begin() -> datetime.datetime:
+    return datetime.datetime.now() - datetime.timedelta(days=app.config.MIRROR.DAYS)
+
+
+def search(criteria: str, folder: str, read: Callable) -> List[bytes]:
+    """Поиск писем в локальной копии папки (после синхронизации).
+    Возвращает ответ в формате UID SEARCH: [b"uid uid ..."].
+    Если копия папки еще не актуальна, возбуждает MirrorIsNotReady"""
+    if not sync(folder, read):
+        raise MirrorIsNotReady(folder)
+    terms = [x.strip() for x in criteria.split(",") if x.strip()]
+    if not terms:
+        return [b""]
+    query = " OR ".join('"{}"'.format(x.replace('"', '""')) for x in terms)
+    rows = _connect().execute(
+        "SELECT m.uid FROM messages_fts f JOIN messages m ON m.id = f.rowid "
+        "WHERE messages_fts MATCH ? AND m.folder = ? AND m.date >= ? "
+        "ORDER BY m.uid",
+        (query, folder, _date_begin().timestamp()),
+    ).fetchall()
+    return [" ".join(str(uid) for uid, in rows).encode()]
+
+
+def sync(folder: str, read: Callable) -> bool:
+    """Синхронизация папки перед поиском. read(ids, folder) - выборка
+    данных писем с сервера (Result или None для писем без вложений).
+    Запрос не ждет синхронизации: первая синхронизация и загрузка более
+    MIRROR.MAX_INLINE писем выполняются в фоновом потоке, пока идет
+    синхронизация, возвращается False (поиск выполняется на сервере)"""
+    lock = _folder_lock(folder)
+    if not lock.acquire(blocking=False):
+        return False
+    background = False
+    try:
+        db = _connect()
+        state = db.execute(
+            "SELECT uidvalidity, uidnext, messages, highestmodseq, synced "
+            "FROM folders WHERE folder = ?",
+            (folder,),
+        ).fetchone()
+        if state and time.time() - state[4] < app.config.MIRROR.SYNC_INTERVAL_SECONDS:
+            return True
+
+        with pooled_connection(folder) as session:
+            current = status(session.imap, folder)
+            if state and state[0] == current.get("uidvalidity"):
+                unchanged = state[1] == current.get("uidnext") and (
+                    state[3] == current["highestmodseq"]
+                    if "highestmodseq" in current
+                    else state[2] == current.get("messages")
+                )
+                if unchanged:
+                    db.execute(
+                        "UPDATE folders SET synced = ? WHERE folder = ?",
+                        (time.time(), folder),
+                    )
+                    return True
+            else:
+                _clear(db, folder)
+                state = None
+
+            date_begin = _date_begin().strftime("%d-%b-%Y")
+            typ, data = session.imap.uid("search", None, "SENTSINCE", date_begin)
+            if typ != "OK":
+                return False
+        server = {int(x) for x in data[0].split()} if data and data[0] else set()
+
+        local = {
+            uid
+            for uid, in db.execute(
+                "SELECT uid FROM messages WHERE folder = ?", (folder,)
+            )
+        }
+        removed = local - server
+        new = sorted(server - local)
+        if state is None or len(new) > app.config.MIRROR.MAX_INLINE:
+            background = True
+            threading.Thread(
+                target=_sync_background,
+                args=(lock, folder, read, current, removed, new),
+                daemon=True,
+            ).start()
+            return False
+        _apply(db, folder, read, current, removed, new)
+        return True
+    finally:
+        if not background:
+            lock.release()
+
+
+def _sync_background(lock, folder: str, read: Callable, current, removed, new):
+    try:
+        _apply(_connect(), folder, read, current, removed, new)
+    except Exception as ex:
+        logger.error(f"Синхронизация папки {folder}: {ex}")
+    finally:
+        lock.release()
+
+
+def _apply(db, folder: str, read: Callable, current: dict, removed: set, new: list):
+    """Удалить из копии папки письма removed, загрузить письма new"""
+    if removed:
+        _delete(db, folder, removed)
+    failed = 0
+    for batch in batches(new, app.config.IMAP_FETCH.BATCH_SIZE):
+        results = read([str(x).encode() for x in batch], folder)
+        failed += _store(db, folder, batch, results)
+    if failed:
+        # без UIDNEXT следующая синхронизация повторит выборку
+        current["uidnext"] = None
+    db.execute(
+        "INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            folder,
+            current.get("uidvalidity"),
+            current.get("uidnext"),
+            current.get("messages"),
+            current.get("highestmodseq"),
+            time.time(),
+        ),
+    )
+    logger.info(
+        f"Синхронизация папки {folder}: новых {len(new)}, удалено {len(removed)}"
+    )
+
+
+def _store(db, folder: str, uids: List[int], results: dict) -> int:
+    """Сохранить письма, возвращает количество не выбранных писем"""
+    failed = 0
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for uid in uids:
+            result = results.get(str(uid).encode())
+            if result and result.error:
+                failed += 1
+                continue
+            files = [x["name"] for x in result.files] if result else []
+            _remove(db, folder, uid)
+            cursor = db.execute(
+                "INSERT INTO messages (folder, uid, date, sender, subject, files) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    folder,
+                    uid,
+                    result.date.timestamp() if result and result.date else 0,
+                    result.sender if result else "",
+                    result.subject if result else "",
+                    json.dumps(files, ensure_ascii=False),
+                ),
+            )
+            if result:
+                text = "\n".join(
+                    [result.sender or "", result.subject, result.body] + files
+                )
+                db.execute(
+                    "INSERT INTO messages_fts (rowid, text) VALUES (?, ?)",
+                    (cursor.lastrowid, text),
+                )
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    return failed
+
+
+def _delete(db, folder: str, uids):
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for uid in uids:
+            _remove(db, folder, uid)
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+
+
+def _remove(db, folder: str, uid: int):
+    row = db.execute(
+        "SELECT id FROM messages WHERE folder = ? AND uid = ?", (folder, uid)
+    ).fetchone()
+    if row:
+        db.execute("DELETE FROM messages_fts WHERE rowid = ?", row)
+        db.execute("DELETE FROM messages WHERE id = ?", row)
+
+
+def _clear(db, folder: str):
+    db.execute("DELETE FROM folders WHERE folder = ?", (folder,))
+    db.execute(
+        "DELETE FROM messages_fts WHERE rowid IN "
+        "(SELECT id FROM messages WHERE folder = ?)",
+        (folder,),
+    )
+    db.execute("DELETE FROM messages WHERE folder = ?", (folder,))
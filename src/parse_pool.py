@@ -0,0 +1,73 @@
+"""Пул процессов для разбора текста писем (base64, HTML).
+Потоки ввода-вывода передают в пул текстовые части писем (без вложений)
+и ожидают результат, поэтому разбор пакетов идет на нескольких ядрах
+параллельно с выборкой.
+Число задач в пуле ограничено PARSE_POOL.MAX_PENDING: при заполнении
+потоки выборки ожидают (обратное давление). Небольшие ответы
+разбираются в вызывающем потоке.
+Пул создается по первому запросу, когда в процессе уже работают потоки
+ввода-вывода и предвыборки, поэтому процессы запускаются через
+forkserver, а не fork: копия блокировки, захваченной другим потоком
+в момент fork, осталась бы захваченной в дочернем процессе навсегда"""
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable
+from src import app
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_pid = None
+_lock = threading.Lock()
+_pending = None
+
+
+def _get_executor():
+    global _executor, _pid, _pending
+    with _lock:
+        if _executor is None or _pid != os.getpid():
+            config = app.config.PARSE_POOL
+            _executor = ProcessPoolExecutor(
+                max_workers=config.WORKERS,
+                mp_context=multiprocessing.get_context(
+                    config.get("START_METHOD", "forkserver")
+                ),
+            )
+            _pid = os.getpid()
+            _pending = threading.BoundedSemaphore(config.MAX_PENDING)
+        return _executor, _pending
+
+
+def _reset(executor):
+    global _executor
+    with _lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def payload_size(data: list) -> int:
+    """Размер литералов ответа imaplib"""
+    return sum(len(x[1]) for x in data or [] if isinstance(x, tuple) and x[1])
+
+
+def run(fn: Callable, *args, size: int = 0):
+    """Выполнить fn(*args) в пуле процессов (или в текущем потоке,
+    если пул отключен или данных меньше PARSE_POOL.MIN_SIZE)"""
+    config = app.config.get("PARSE_POOL")
+    if not config or config.WORKERS <= 0 or size < config.MIN_SIZE:
+        return fn(*args)
+    executor, pending = _get_executor()
+    pending.acquire()
+    try:
+        return executor.submit(fn, *args).result()
+    except BrokenProcessPool as ex:
+        logger.error(f"{ex}")
+        _reset(executor)
+        return fn(*args)
+    finally:
+        pending.release()
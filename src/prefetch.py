@@ -0,0 +1,113 @@
+"""Предварительная выборка популярных запросов.
+Запросы списка писем (inn, ogrn, path) учитываются в Redis (zset с
+затухающим счетчиком). Фоновый поток одного из воркеров (лидер)
+периодически повторяет самые частые запросы, чтобы кеши поиска и
+писем были заполнены до обращения пользователей. Число одновременных
+запросов, время цикла и доля занятых IMAP-соединений ограничены"""
+import json
+import time
+import logging
+import threading
+import multiprocessing
+import redis
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from src import app
+from src.imap_pool import pool
+from src.redis_cache import redis_client, available
+
+logger = logging.getLogger(__name__)
+
+HOT = "imap:hot"
+LEADER = "imap:prefetch:leader"
+
+_started = False
+_started_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return bool(app.config.get("PREFETCH") and app.config.PREFETCH.ENABLED)
+
+
+def record(inn: str, ogrn: str, path: set):
+    """Учесть запрос списка писем"""
+    if not enabled() or not available() or not (inn or ogrn):
+        return
+    member = json.dumps(
+        {"inn": inn or None, "ogrn": ogrn or None, "path": sorted(path or ())},
+        ensure_ascii=False,
+    )
+    try:
+        redis_client.zincrby(HOT, 1, member)
+    except redis.RedisError as ex:
+        logger.warning(f"{ex}")
+
+
+def start(fetch: Callable, pools: Callable = None):
+    """Запустить фоновую выборку в воркере. fetch(**param) - выборка
+    списка писем (api.fetch_messages), pools() - пулы IMAP-соединений
+    выбранного движка (api.connection_pools)"""
+    global _started
+    # процессы пула разбора (parse_pool) импортируют пакет заново
+    if not enabled() or multiprocessing.parent_process() is not None:
+        return
+    with _started_lock:
+        if _started:
+            return
+        _started = True
+    threading.Thread(
+        target=_run, args=(fetch, pools or (lambda: [pool])), daemon=True
+    ).start()
+
+
+def _run(fetch: Callable, pools: Callable):
+    config = app.config.PREFETCH
+    while True:
+        time.sleep(config.INTERVAL_SECONDS)
+        try:
+            if available() and _lead(config.INTERVAL_SECONDS):
+                prefetch(fetch, pools)
+        except Exception as ex:
+            logger.error(f"{ex}")
+
+
+def _lead(seconds: int) -> bool:
+    """Цикл выполняет только один воркер"""
+    return bool(redis_client.set(LEADER, "1", nx=True, ex=max(int(seconds), 1)))
+
+
+def hot_queries() -> list:
+    """Самые частые запросы; счетчики затухают на каждом цикле"""
+    config = app.config.PREFETCH
+    rows = redis_client.zrevrange(HOT, 0, config.MAX_QUERIES - 1, withscores=True)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.zunionstore(HOT, {HOT: config.DECAY})
+    pipe.zremrangebyscore(HOT, "-inf", 0.5)
+    pipe.zremrangebyrank(HOT, 0, -config.MAX_QUERIES * 4 - 1)
+    pipe.execute()
+    return [json.loads(member) for member, score in rows if score >= config.MIN_HITS]
+
+
+def busy(pools: Callable) -> bool:
+    """Живые запросы занимают один из пулов IMAP-соединений"""
+    return any(
+        x.in_use() >= x.max_size * app.config.PREFETCH.POOL_SHARE for x in pools()
+    )
+
+
+def prefetch(fetch: Callable, pools: Callable = lambda: [pool]):
+    config = app.config.PREFETCH
+    deadline = time.monotonic() + config.BUDGET_SECONDS
+    queries = hot_queries()
+    done = 0
+
+    def run(query: dict):
+        nonlocal done
+        if time.monotonic() > deadline or busy(pools):
+            return
+        fetch(id=None, inn=query["inn"], ogrn=query["ogrn"], path=set(query["path"]))
+        done += 1
+
+    with ThreadPoolExecutor(max_workers=config.CONCURRENCY) as executor:
+        list(executor.map(run, queries))
+    logger.info(f"Предварительная выборка: {done} из {len(queries)} запросов")
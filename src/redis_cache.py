@@ -1,62 +1,486 @@
+import os
+import time
+import uuid
 import logging
+import threading
 import redis
-import pickle
-from functools import lru_cache, wraps
+from collections import OrderedDict
+from functools import wraps
 from src import app
+from src.cache_codec import make_key, encode, decode
+from src.exceptions import CachedFailure
 
 logger = logging.getLogger(__name__)
 
-# Подключение к Redis
+
+class CacheUnavailable(redis.ConnectionError):
+    """Redis отключен автоматическим выключателем"""
+
+
+class CircuitBreaker:
+    """Автоматический выключатель Redis: после threshold ошибок соединения
+    подряд обращения к Redis прекращаются, фоновый поток проверяет
+    соединение каждые retry_seconds и включает Redis снова"""
+
+    def __init__(self, probe, threshold: int = 3, retry_seconds: float = 5):
+        self.probe = probe
+        self.threshold = threshold
+        self.retry_seconds = retry_seconds
+        self.failures = 0
+        self.closed = True
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = os.getpid()
+
+    def guard(self, fn, *args, **kwargs):
+        if not self.available():
+            raise CacheUnavailable("Redis is not available")
+        try:
+            result = fn(*args, **kwargs)
+        except (redis.ConnectionError, redis.TimeoutError) as ex:
+            self.failure(ex)
+            raise
+        self.failures = 0
+        return result
+
+    def available(self) -> bool:
+        if not self.closed:
+            self._start()
+        return self.closed
+
+    def failure(self, ex):
+        with self._lock:
+            self.failures += 1
+            if not self.closed or self.failures < self.threshold:
+                return
+        self.trip(ex)
+
+    def trip(self, ex):
+        """Отключить Redis до восстановления соединения"""
+        with self._lock:
+            self.closed = False
+        logger.warning(f"Redis is not available, using local cache: {ex}")
+        self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # после fork поток родительского процесса не существует
+                self._pid = os.getpid()
+                self._thread = None
+            if self.closed or self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._reconnect, daemon=True)
+            self._thread.start()
+
+    def _reconnect(self):
+        while True:
+            time.sleep(self.retry_seconds)
+            try:
+                self.probe()
+            except redis.RedisError:
+                continue
+            with self._lock:
+                self.failures = 0
+                self.closed = True
+                self._thread = None
+            logger.warning("Redis connection restored.")
+            return
+
+
+class GuardedRedis(redis.StrictRedis):
+    """Клиент Redis, команды и конвейеры которого проходят через выключатель"""
+
+    breaker: CircuitBreaker = None
+
+    def execute_command(self, *args, **options):
+        return self.breaker.guard(super().execute_command, *args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super().pipeline(transaction, shard_hint)
+        execute = pipe.execute
+        pipe.execute = lambda *args, **kwargs: self.breaker.guard(
+            execute, *args, **kwargs
+        )
+        return pipe
+
+
+# Подключение к Redis с короткими таймаутами
+redis_client = GuardedRedis(
+    host=app.config.REDIS.HOST,
+    port=app.config.REDIS.PORT,
+    db=app.config.REDIS.DB,
+    socket_timeout=app.config.REDIS.SOCKET_TIMEOUT_SECONDS,
+    socket_connect_timeout=app.config.REDIS.SOCKET_TIMEOUT_SECONDS,
+)
+redis_client.breaker = CircuitBreaker(
+    probe=lambda: redis.StrictRedis.execute_command(redis_client, "PING"),
+    threshold=app.config.REDIS.FAILURE_THRESHOLD,
+    retry_seconds=app.config.REDIS.RETRY_SECONDS,
+)
 try:
-    redis_client = redis.StrictRedis(
-        host=app.config.REDIS.HOST, port=app.config.REDIS.PORT, db=app.config.REDIS.DB
-    )
     redis_client.ping()  # Проверяем соединение с Redis
-    redis_available = True
-except redis.ConnectionError:
-    logger.warning("Redis is not available, using local cache.")
-    redis_available = False
+except redis.RedisError as ex:
+    redis_client.breaker.trip(ex)
+
+
+def available() -> bool:
+    """Redis доступен (выключатель не сработал)"""
+    return redis_client.breaker.available()
+
+
+# Снятие блокировки, только если она принадлежит вызывающему
+_release_lock = redis_client.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then "
+    "return redis.call('del', KEYS[1]) else return 0 end"
+)
+
+
+class LocalCache:
+    """Локальный (в памяти воркера) LRU-кеш с временем жизни записей.
+    Ограничен количеством записей и их суммарным размером в байтах
+    (размер записи - длина ее сериализованного представления)"""
+
+    def __init__(self, maxsize: int = 1024, max_bytes: int = 0, ttl: float = 60):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """(найдено, значение)"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] < time.monotonic():
+                self._pop(key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, item[1]
+
+    def set(self, key: str, value, size: int = 0, ttl: float = None):
+        if self.maxsize <= 0 or self.max_bytes and size > self.max_bytes:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (time.monotonic() + ttl, value, size)
+            self._bytes += size
+            while len(self._data) > self.maxsize or (
+                self.max_bytes and self._bytes > self.max_bytes
+            ):
+                self._pop(next(iter(self._data)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
 
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
 
-# Декоратор для работы с Redis или lru_cache в зависимости от доступности
-def cache(expiration_seconds):
+    def _pop(self, key: str):
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+
+# Декоратор двухуровневого кеша: локальный кеш воркера (L1) и Redis (L2).
+# Пока Redis недоступен, записи хранятся в локальном кеше весь срок.
+# Параметры локального кеша по умолчанию задаются в LOCAL_CACHE
+def cache(
+    expiration_seconds,
+    local_maxsize: int = None,
+    local_max_bytes: int = None,
+    local_ttl: float = None,
+):
     def decorator(func):
-        if redis_available:
-            return redis_cache(func, expiration_seconds)
-        else:
-            return lru_cache_cache(func)
+        config = app.config.LOCAL_CACHE
+        local = LocalCache(
+            maxsize=config.MAX_SIZE if local_maxsize is None else local_maxsize,
+            max_bytes=config.MAX_BYTES if local_max_bytes is None else local_max_bytes,
+            ttl=min(
+                config.TTL_SECONDS if local_ttl is None else local_ttl,
+                expiration_seconds,
+            ),
+        )
+        return redis_cache(func, expiration_seconds, local)
 
     return decorator
 
 
+def _cache_name(func) -> str:
+    return f"{func.__module__.rsplit('.', 1)[-1]}.{func.__name__}"
+
+
 # Реализация Redis-кеша с указанием времени жизни 1 l день по-умолчанию
-def redis_cache(func, expiration_seconds=24 * 60 * 60):
+def redis_cache(func, expiration_seconds=24 * 60 * 60, local: LocalCache = None):
+    name = _cache_name(func)
+    local = local or LocalCache(maxsize=0)
+    negative_seconds = min(app.config.REDIS.NEGATIVE_EXPIRATION_SECONDS, expiration_seconds)
+
     @wraps(func)
     def wrapper(*args):
-        cache_key = str(args)
+        """Значение вычисляет только один вызов (во всех воркерах),
+        остальные ожидают его результат в кеше"""
+        cache_key = make_key(name, args)
+        deadline = time.monotonic() + app.config.REDIS.LOCK_SECONDS
+        while True:
+            found, result = get(cache_key)
+            if found:
+                if isinstance(result, CachedFailure):
+                    raise result
+                return result
+            token = acquire(cache_key)
+            if token or time.monotonic() > deadline:
+                try:
+                    return compute(cache_key, args)
+                finally:
+                    if token:
+                        release(cache_key, token)
+            time.sleep(app.config.REDIS.LOCK_POLL_SECONDS)
+
+    def compute(cache_key: str, args: tuple):
+        try:
+            result = func(*args)
+        except Exception as ex:
+            # кратковременно запоминаем ошибку для ожидающих вызовов
+            put(cache_key, CachedFailure(f"{ex}"), negative_seconds)
+            raise
+        # None - письмо не найдено: оно может появиться позже
+        put(
+            cache_key,
+            result,
+            expiration_seconds if result is not None else negative_seconds,
+        )
+        return result
+
+    def acquire(cache_key: str):
+        token = uuid.uuid4().hex
+        if not available():
+            # без Redis вычисляем без блокировки
+            return token
+        try:
+            if redis_client.set(
+                f"{cache_key}:lock", token, nx=True, ex=app.config.REDIS.LOCK_SECONDS
+            ):
+                return token
+        except redis.RedisError:
+            return token
+        return None
+
+    def release(cache_key: str, token: str):
+        if not available():
+            return
+        try:
+            _release_lock(keys=[f"{cache_key}:lock"], args=[token])
+        except redis.RedisError:
+            logger.warning("Redis connection failed, lock is not released.")
+
+    def get(cache_key: str):
+        """(найдено, значение) с учетом запомненных ошибок"""
+        found, result = local.get(cache_key)
+        if found or not available():
+            return found, result
         try:
             cached_result = redis_client.get(cache_key)
-            if cached_result:
-                return pickle.loads(cached_result)  # Возвращаем результат из Redis-кеша
-        except redis.ConnectionError:
-            logger.warning("Redis connection failed, switching to local cache.")
-            return lru_cache_cache(func)(
-                *args
-            )  # В случае ошибки Redis используем lru_cache
-
-        result = func(*args)
-        try:
-            redis_client.set(
-                cache_key, pickle.dumps(result), ex=expiration_seconds
-            )  # Устанавливаем срок действия ключа
-        except redis.ConnectionError:
-            logger.error("Failed to cache result in Redis, using local cache.")
+        except redis.RedisError as ex:
+            logger.warning(f"Redis: {ex}")
+            return False, None
+        if cached_result:
+            try:
+                result = decode(cached_result)
+            except ValueError as ex:
+                logger.warning(f"{cache_key}: {ex}")
+                return False, None
+            local.set(cache_key, result, len(cached_result))
+            return True, result
+        return False, None
 
-        return result
+    def local_ttl(seconds: int) -> float:
+        # пока Redis недоступен, локальный кеш хранит запись весь срок
+        return min(seconds, local.ttl) if available() else seconds
 
-    return wrapper
+    def put(cache_key: str, result, seconds: int):
+        data = encode(result)
+        # локальная копия - в том же виде, что и в Redis
+        local.set(cache_key, decode(data), len(data), ttl=local_ttl(seconds))
+        if not available():
+            return
+        try:
+            redis_client.set(cache_key, data, ex=seconds)
+        except redis.RedisError as ex:
+            logger.error(f"Failed to cache result in Redis: {ex}")
+
+    def lookup(*args):
+        """Значение из кеша без вызова функции: (найдено, значение)"""
+        found, result = get(make_key(name, args))
+        if isinstance(result, CachedFailure):
+            return False, None
+        return found, result
+
+    def store(args, result):
+        """Сохранить в кеше значение, вычисленное вне функции"""
+        put(make_key(name, args), result, expiration_seconds)
+
+    def lookup_many(args_list: list, failures: bool = False) -> list:
+        """Пакетный lookup: локальный кеш, затем один MGET для промахов.
+        Запомненные ошибки - промахи, если не задано failures"""
+        keys = [make_key(name, args) for args in args_list]
+        found = [local.get(key) for key in keys]
+        missed = [i for i, (hit, _) in enumerate(found) if not hit]
+        if missed and available():
+            try:
+                values = redis_client.mget([keys[i] for i in missed])
+            except redis.RedisError as ex:
+                logger.warning(f"Redis: {ex}")
+                values = []
+            for i, cached_result in zip(missed, values):
+                if not cached_result:
+                    continue
+                try:
+                    result = decode(cached_result)
+                except ValueError as ex:
+                    logger.warning(f"{keys[i]}: {ex}")
+                    continue
+                local.set(keys[i], result, len(cached_result))
+                found[i] = (True, result)
+        if failures:
+            return found
+        return [
+            (False, None) if isinstance(result, CachedFailure) else (hit, result)
+            for hit, result in found
+        ]
+
+    def acquire_many(args_list: list) -> dict:
+        """Блокировки ключей одним конвейером SET NX EX: {args: token}
+        для взятых блокировок (без Redis - для всех ключей)"""
+        tokens = {args: uuid.uuid4().hex for args in args_list}
+        if not available():
+            return tokens
+        try:
+            pipeline = redis_client.pipeline(transaction=False)
+            for args, token in tokens.items():
+                pipeline.set(
+                    f"{make_key(name, args)}:lock",
+                    token,
+                    nx=True,
+                    ex=app.config.REDIS.LOCK_SECONDS,
+                )
+            locked = pipeline.execute()
+        except redis.RedisError:
+            return tokens
+        return {args: tokens[args] for args, ok in zip(tokens, locked) if ok}
+
+    def release_many(tokens: dict):
+        if not tokens or not available():
+            return
+        try:
+            pipeline = redis_client.pipeline(transaction=False)
+            for args, token in tokens.items():
+                _release_lock(
+                    keys=[f"{make_key(name, args)}:lock"], args=[token], client=pipeline
+                )
+            pipeline.execute()
+        except redis.RedisError:
+            logger.warning("Redis connection failed, locks are not released.")
+
+    def compute_many(args_list: list, compute) -> dict:
+        """Вычислить значения compute(args_list) -> {args: значение} под
+        взятыми блокировками. compute сам сохраняет значения в кеше"""
+        try:
+            values = compute(args_list)
+        except Exception as ex:
+            logger.error(f"{ex}")
+            values = {args: ex for args in args_list}
+        return settle_many(args_list, values)
+
+    def settle_many(args_list: list, values: dict) -> dict:
+        """Ошибки вычисления (исключения в значениях или отсутствующие ключи)
+        кратковременно запоминаются как CachedFailure для ожидающих вызовов"""
+        for args in args_list:
+            value = values.get(args, CachedFailure("Значение не вычислено"))
+            if isinstance(value, Exception):
+                if not isinstance(value, CachedFailure):
+                    value = CachedFailure(f"{value}")
+                put(make_key(name, args), value, negative_seconds)
+                values[args] = value
+        return values
 
+    def get_many(args_list: list, compute) -> dict:
+        """Пакетный аналог wrapper: значения, которых нет в кеше, вычисляет
+        compute(args_list) только вызов, взявший блокировки их ключей (во всех
+        воркерах), остальные ожидают их появления в кеше не дольше
+        REDIS.LOCK_SECONDS. Возвращает {args: значение}, ошибки - CachedFailure"""
+        values = {}
+        pending = list(args_list)
+        deadline = time.monotonic() + app.config.REDIS.LOCK_SECONDS
+        while pending:
+            for args, (hit, result) in zip(pending, lookup_many(pending, True)):
+                if hit:
+                    values[args] = result
+            pending = [args for args in pending if args not in values]
+            if not pending:
+                break
+            tokens = acquire_many(pending)
+            owned = [args for args in pending if args in tokens]
+            if not owned and time.monotonic() > deadline:
+                owned = pending
+            if owned:
+                try:
+                    values.update(compute_many(owned, compute))
+                finally:
+                    release_many(tokens)
+                pending = [args for args in pending if args not in values]
+                continue
+            time.sleep(app.config.REDIS.LOCK_POLL_SECONDS)
+        return values
 
-# Реализация lru_cache для локального кеширования
-def lru_cache_cache(func):
-    return lru_cache(maxsize=1024)(func)
+    def store_many(items: list):
+        """Пакетный store [(args, result)] одним конвейером SET ... EX.
+        None (письмо не найдено) хранится кратковременно, как и в compute;
+        остальные значения, в том числе NO_ATTACHMENTS, - весь срок"""
+        if not items:
+            return
+        pipeline = redis_client.pipeline(transaction=False)
+        for args, result in items:
+            cache_key = make_key(name, args)
+            seconds = expiration_seconds if result is not None else negative_seconds
+            data = encode(result)
+            local.set(cache_key, decode(data), len(data), ttl=local_ttl(seconds))
+            pipeline.set(cache_key, data, ex=seconds)
+        if not available():
+            return
+        try:
+            pipeline.execute()
+        except redis.RedisError as ex:
+            logger.error(f"Failed to cache result in Redis: {ex}")
+
+    wrapper.lookup = lookup
+    wrapper.store = store
+    wrapper.lookup_many = lookup_many
+    wrapper.acquire_many = acquire_many
+    wrapper.release_many = release_many
+    wrapper.compute_many = compute_many
+    wrapper.settle_many = settle_many
+    wrapper.get_many = get_many
+    wrapper.store_many = store_many
+    wrapper.local = local
+    wrapper.cache_stats = local.stats
+    return wrapper
@@ -1,45 +1,139 @@
-import re
 import hashlib
 import datetime
 import logging
 import json_fix
 from typing import Any
+from src.matcher import Matcher, criteria_matcher
 
 logger = logging.getLogger(__name__)
 
+# письмо есть в папке, но без вложений: в отличие от None (письмо не
+# найдено) хранится в кеше весь срок
+NO_ATTACHMENTS = False
+
 
 class Result:
+    # размер фрагмента текста письма и число выделений в нем
+    SNIPPET_SIZE = 300
+    MAX_HIGHLIGHTS = 5
+
+    __slots__ = (
+        "criteria",
+        "id",
+        "subject",
+        "date",
+        "body",
+        "snippet",
+        "highlights",
+        "sender",
+        "files",
+        "path",
+        "error",
+    )
+
     def __init__(self, criteria: str = "", error_message: str = ""):
-        try:
-            patt = r'["0-9а-яёА-ЯЁ:\\\/\s-]'
-            self.criteria = criteria
-            self.compile: re.compile = re.compile(
-                patt + "*?" + "(?:" + self.criteria.replace(",", "|") + ")" + patt + "*",
-                re.I,
-            )
-            self.id: bytes = b"0"
-            self.subject: str = ""
-            self.date = None
-            self.body: str = error_message
-            self.sender: str = ""
-            self.files: list = []
-            self.path: str = ""
-            self.error: str = error_message
-        except Exception as ex:
-            logger.error(f"{ex}")
-            raise
+        self.criteria = criteria
+        self.id: bytes = b"0"
+        self.subject: str = ""
+        self.date = None
+        self.body: str = error_message
+        self.snippet: str = ""
+        self.highlights: list = []
+        self.sender: str = ""
+        self.files: list = []
+        self.path: str = ""
+        self.error: str = error_message
+
+    @property
+    def matcher(self) -> Matcher:
+        return criteria_matcher(self.criteria)
 
     @classmethod
     def hashit(cls, s):
         return hashlib.sha1(s.encode("utf-8")).hexdigest()[:8]
 
-    def find_in_body(self):
-        return self.compile.findall(self.body)
+    @classmethod
+    def file_info(cls, section: str, filename: str, size: int, type: str) -> dict:
+        """Описание вложения. Идентификатор учитывает секцию письма,
+        поэтому одноименные вложения различаются"""
+        return {
+            "id": cls.hashit(f"{section}/{filename}"),
+            "name": filename,
+            "size": size,
+            "type": type,
+            "section": section,
+        }
 
-    def find(self):
-        return self.compile.findall(self.subject + self.body) or any(
-            self.compile.findall(x) for x in self.files
+    @classmethod
+    def file_selected(cls, file: dict, att_ids: str) -> bool:
+        """Вложение запрошено по идентификатору att_ids ("0" - все вложения).
+        Поддерживаются и прежние идентификаторы по имени файла"""
+        if not att_ids or att_ids == "0":
+            return True
+        return file["id"] in att_ids or cls.hashit(file["name"]) in att_ids
+
+    def set_body(self, text: str):
+        """Текст письма и фрагмент вокруг первого найденного ИНН/ОГРН"""
+        self.body = text
+        self.snippet, self.highlights = self.make_snippet(text)
+
+    def make_snippet(self, text: str):
+        """Фрагмент текста не длиннее SNIPPET_SIZE и позиции
+        найденных в нем критериев [(начало, конец)]"""
+        matches = [(a, b) for _, a, b in self.matcher.search(text)]
+        start = 0
+        if matches:
+            start = max(matches[0][0] - self.SNIPPET_SIZE // 3, 0)
+        end = start + self.SNIPPET_SIZE
+        highlights = [
+            (a - start, b - start) for a, b in matches if a >= start and b <= end
+        ]
+        return text[start:end], highlights[: self.MAX_HIGHLIGHTS]
+
+    def to_record(self) -> dict:
+        """Поля результата для хранения в кеше (без полного текста письма)"""
+        return {
+            "id": self.id.decode("utf-8"),
+            "criteria": self.criteria,
+            "subject": self.subject,
+            "date": self.date.isoformat() if self.date else None,
+            "snippet": self.snippet,
+            "highlights": self.highlights,
+            "sender": self.sender,
+            "files": self.files,
+            "path": self.path,
+            "error": self.error,
+        }
+
+    @classmethod
+    def from_record(cls, record: dict) -> "Result":
+        result = cls(record["criteria"])
+        result.id = record["id"].encode("utf-8")
+        result.subject = record["subject"]
+        result.date = (
+            datetime.datetime.fromisoformat(record["date"]) if record["date"] else None
         )
+        result.snippet = record["snippet"]
+        result.highlights = [tuple(x) for x in record["highlights"]]
+        result.sender = record["sender"]
+        result.files = record["files"]
+        result.path = record["path"]
+        result.error = record["error"]
+        return result
+
+    def find_in_body(self) -> list:
+        """Вхождения критериев в текст письма: [(ИНН/ОГРН, начало, конец)]"""
+        return self.matcher.search(self.body or self.snippet)
+
+    def find(self) -> dict:
+        """Где найден каждый критерий: {ИНН/ОГРН: ["subject", "body", имя файла]}"""
+        places = {}
+        texts = [("subject", self.subject), ("body", self.body or self.snippet)]
+        texts += [(x["name"], x["name"]) for x in self.files]
+        for place, text in texts:
+            for term in self.matcher.found(text):
+                places.setdefault(term, []).append(place)
+        return places
 
     def __json__(self):
         try:
@@ -48,10 +142,14 @@ class Result:
                 "sender": self.sender,
                 "subject": self.subject,
                 "date": self.date.strftime("%Y-%m-%d %H:%M:%S"),
-                "body": self.body,
+                "snippet": self.snippet,
+                "highlights": self.highlights,
                 "path": self.path,
                 "files": self.files,
             }
+            if self.body:
+                # полный текст только по запросу (fields=body)
+                data["body"] = self.body
         except Exception as ex:
             logger.error(f"{ex}")
             raise
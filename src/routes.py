@@ -15,12 +15,19 @@ from flask_api import status
 from flask_restful import abort
 from sentry_sdk import capture_exception
 
-from src import app, api
+from src import app, api, api_async, blob_cache, prefetch, cursor, token_index
 from src.auth import multi_auth
 from src.result import Result
 
 logger = logging.getLogger(__name__)
 
+# движок IMAP: sync - imaplib в потоках, async - aioimaplib в цикле событий воркера
+if app.config.get("IMAP_BACKEND") == "async":
+    api = api_async
+
+# фоновая выборка популярных запросов
+prefetch.start(api.fetch_messages, api.connection_pools)
+
 
 @app.route("/mail", defaults={"id": None})
 @app.route("/mail/<int:id>", endpoint="mail_with_id", methods=["GET"])
@@ -35,11 +42,43 @@ def fetch_messages(id):
     param, param_page = __get_param(id=id)
     data = multi_auth.current_user()
     __check_auth(data, param)
-    result = api.fetch_messages(**param)
-    __check_result(result)
+    if id is None:
+        # список писем постранично по курсору: поиск только на первой странице
+        query = {
+            "inn": param["inn"],
+            "ogrn": param["ogrn"],
+            "path": sorted(param["path"]),
+        }
+        page = cursor.load(request.args.get("cursor"), query)
+        if page is None:
+            prefetch.record(param["inn"], param["ogrn"], param["path"])
+            result = api.fetch_messages(**param)
+            __check_result(result)
+            criteria = api.get_search_text(**param)
+            page = {"criteria": criteria, "handles": cursor.handles(result)}
+            param_page["cursor"] = cursor.save(query, criteria, page["handles"])
+            # первая страница - из только что полученных результатов
+            result = result[__get_page_slice(**param_page)]
+        else:
+            param_page["cursor"] = request.args.get("cursor")
+            handles = page["handles"][__get_page_slice(**param_page)]
+            result = api.fetch_results(handles, page["criteria"])
+        count = len(page["handles"])
+    else:
+        result = api.fetch_messages(**param)
+        __check_result(result)
+        count = len(result)
+        result = result[__get_page_slice(**param_page)]
+    # полный текст писем только по запросу, в списке - фрагмент
+    if "body" in request.args.get("fields", "").split(","):
+        criteria = api.get_search_text(**param) if id is None else ""
+        result = api.fetch_bodies(result, criteria)
+    else:
+        for x in result:
+            x.body = ""
     try:
         url = __get_url_without_page()
-        paginat = __get_pagination(result, url, **(param | param_page))
+        paginat = __get_pagination(result, count, url, **(param | param_page))
         if param_page["json"] in "true,yes,1":
             return jsonify(paginat)
         else:
@@ -51,6 +90,36 @@ def fetch_messages(id):
         abort(status.HTTP_500_INTERNAL_SERVER_ERROR, **dict(message=f"{ex}"))
 
 
+@app.route("/mail/batch", endpoint="mail_batch", methods=["POST"])
+@multi_auth.login_required()
+@swag_from("../docs/batch.yml", endpoint="mail_batch")
+def fetch_batch():
+    """пакетный поиск писем по списку ИНН/ОГРН.
+    Поиск в папке выполняется один раз для всех ИНН/ОГРН,
+    найденные письма распределяются по каждому ИНН/ОГРН
+    """
+    param, _ = __get_param()
+    tokens = __get_batch_tokens()
+    data = multi_auth.current_user()
+    __check_batch_auth(data, tokens)
+    found, errors = api.fetch_batch(tokens, param["path"])
+    # полный текст писем только по запросу, в списке - фрагмент
+    if "body" not in request.args.get("fields", "").split(","):
+        for results in found.values():
+            for x in results:
+                x.body = ""
+    return jsonify(
+        {
+            "count": sum(len(x) for x in found.values()),
+            "results": {
+                token: {"count": len(results), "results": results}
+                for token, results in found.items()
+            },
+            "errors": [x.error for x in errors],
+        }
+    )
+
+
 @app.route("/mail/<int:id>/attachments", defaults={"attach": "0"})
 @app.route(
     "/mail/<int:id>/attachments/<string:attach>",
@@ -84,7 +153,9 @@ def fetch_attachments(id: int, attach: str):
                     status=status.HTTP_404_NOT_FOUND,
                 )
         finally:
-            __remove_files(os.path.dirname(filename))
+            # файлы из кеша вложений остаются для повторных загрузок
+            if not blob_cache.contains(filename):
+                __remove_files(os.path.dirname(filename))
 
     abort(status.HTTP_404_NOT_FOUND, **dict(message="file not found "))
 
@@ -204,22 +275,32 @@ def __remove_files(path: str):
         rmtree(path)
 
 
+def __get_page_slice(**param) -> slice:
+    return slice(
+        (param["page"] - 1) * param["page_size"], param["page"] * param["page_size"]
+    )
+
+
 def __get_url_without_page():
-    """убрать параметры page и page_size из url"""
+    """убрать параметры page, page_size и cursor из url"""
     url = request.host_url
     path_b = re.findall(".+(?=\?)", request.full_path)
     if path_b:
         path_b = path_b[0]
     path_a = re.findall("(?<=\?).+", request.full_path)
     if path_a:
-        path_a = re.sub("&page=[0-9]*|&page_size=[0-9]*", "", path_a[0])
+        path_a = re.sub(
+            "&page=[0-9]*|&page_size=[0-9]*|&?cursor=[^&]*", "", path_a[0]
+        )
     return url.rstrip("/") + path_b + ("?" + path_a if path_a else "")
 
 
-def __get_pagination(data: list, url, **param):
-    count = len(data)
+def __get_pagination(data: list, count: int, url, **param):
+    """data - письма текущей страницы, count - всего писем"""
     page_num = param["page"]
     page_size = param["page_size"]
+    if param.get("cursor"):
+        url += "&cursor={0}".format(param["cursor"])
     max_pages = (count // page_size) + (1 if count % page_size != 0 else 0)
     paginat = {}
     paginat["inn"] = param["inn"]
@@ -244,7 +325,7 @@ def __get_pagination(data: list, url, **param):
         paginat["current"] = url + "&page={0}&page_size={1}".format(page_num, page_size)
     else:
         paginat["current"] = url
-    paginat["results"] = data[(page_num - 1) * page_size : page_num * page_size]
+    paginat["results"] = data
     if app.config.DEBUG:
         paginat["timer"] = time.time() - param["timer"]
     return paginat
@@ -258,6 +339,39 @@ def __check_auth(data, param):
         abort(status.HTTP_401_UNAUTHORIZED)
 
 
+def __get_batch_tokens() -> list:
+    """Список ИНН/ОГРН пакетного запроса {"identifiers": [...]}"""
+    body = request.get_json(silent=True)
+    tokens = body.get("identifiers") if isinstance(body, dict) else None
+    if not tokens or not isinstance(tokens, list):
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            **dict(message="Не задан список ИНН/ОГРН (identifiers)"),
+        )
+    tokens = list(dict.fromkeys(str(x).strip() for x in tokens))
+    if len(tokens) > app.config.BATCH.MAX_IDENTIFIERS:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            **dict(message=f"Не более {app.config.BATCH.MAX_IDENTIFIERS} ИНН/ОГРН"),
+        )
+    invalid = [x for x in tokens if not token_index.is_token(x)]
+    if invalid:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            **dict(message=f"Неверные ИНН/ОГРН: {', '.join(invalid[:10])}"),
+        )
+    return tokens
+
+
+def __check_batch_auth(data, tokens: list):
+    """Пакетный запрос: токен с признаком batch или только свои ИНН/ОГРН"""
+    if data["error"]:
+        abort(status.HTTP_400_BAD_REQUEST, **dict(message=data["error"]))
+
+    if not data.get("batch") and not set(tokens) <= {data["inn"], data["ogrn"]}:
+        abort(status.HTTP_401_UNAUTHORIZED)
+
+
 def __check_result(result):
     if isinstance(result, list):
         if (
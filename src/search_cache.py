@@ -0,0 +1,78 @@
+"""Кеш результатов UID SEARCH по (критерий, папка, UIDVALIDITY).
+При росте папки (UIDNEXT) поиск выполняется только среди новых писем"""
+import json
+import hashlib
+import logging
+import datetime
+import redis
+from typing import List, Optional, Tuple
+from src import app
+from src.redis_cache import redis_client, available
+
+logger = logging.getLogger(__name__)
+
+
+def _key(criteria: str, folder: str) -> str:
+    digest = hashlib.sha1(f"{folder}\n{criteria}".encode("utf-8")).hexdigest()
+    return f"imap:search:{digest}"
+
+
+def get(
+    criteria: str, folder: str, state: dict, date_begin: datetime.datetime
+) -> Tuple[Optional[List[bytes]], Optional[int]]:
+    """Закешированные UID и UID, с которого нужно дополнить поиск:
+    (uids, None) - кеш актуален, (uids, uid) - искать UID uid:*,
+    (None, None) - нужен полный поиск"""
+    if not available() or not state:
+        return None, None
+    try:
+        data = redis_client.get(_key(criteria, folder))
+    except redis.RedisError as ex:
+        logger.warning(f"{ex}")
+        return None, None
+    if not data:
+        return None, None
+    cached = json.loads(data)
+    if (
+        cached["uidvalidity"] != state.get("uidvalidity")
+        or cached["date_begin"] != date_begin.strftime("%Y-%m-%d")
+        or cached["messages"] > state.get("messages", 0)
+    ):
+        # письма удалены или период поиска сдвинулся
+        return None, None
+    uids = [str(x).encode() for x in cached["uids"]]
+    if cached["uidnext"] == state.get("uidnext"):
+        return uids, None
+    return uids, cached["uidnext"]
+
+
+def put(
+    criteria: str,
+    folder: str,
+    state: dict,
+    date_begin: datetime.datetime,
+    uids: List[bytes],
+):
+    if not available() or not state:
+        return
+    data = {
+        "uidvalidity": state.get("uidvalidity"),
+        "uidnext": state.get("uidnext"),
+        "messages": state.get("messages", 0),
+        "date_begin": date_begin.strftime("%Y-%m-%d"),
+        "uids": [int(x) for x in uids],
+    }
+    try:
+        redis_client.set(
+            _key(criteria, folder),
+            json.dumps(data),
+            ex=app.config.SEARCH_CACHE.EXPIRATION_SECONDS,
+        )
+    except redis.RedisError as ex:
+        logger.warning(f"{ex}")
+
+
+def merge(cached: List[bytes], found: List[bytes], since: int) -> List[bytes]:
+    """Дополнить закешированные UID найденными среди UID since:*
+    (сервер всегда возвращает последнее письмо для диапазона n:*)"""
+    return cached + [x for x in found if int(x) >= since and x not in cached]
@@ -0,0 +1,102 @@
+"""Инвертированный индекс ИНН/ОГРН писем в Redis.
+Для каждого 10/12-значного ИНН и 13/15-значного ОГРН хранится список
+писем (папка, UIDVALIDITY, UID) с датой письма. Список считается полным
+для папки, пока не изменился UIDNEXT, зафиксированный при поиске"""
+import re
+import logging
+import datetime
+import redis
+from typing import Iterable, List, Optional
+from src import app
+from src.redis_cache import redis_client, available
+
+logger = logging.getLogger(__name__)
+
+TOKEN = re.compile(r"(?<!\d)(\d{15}|\d{13}|\d{12}|\d{10})(?!\d)")
+
+
+def is_token(value: str) -> bool:
+    return bool(TOKEN.fullmatch(value))
+
+
+def extract(result) -> set:
+    """ИНН и ОГРН из темы, текста и имен файлов письма"""
+    texts = [result.subject or "", result.body or result.snippet or ""]
+    texts += [x["name"] for x in result.files]
+    return {token for text in texts for token in TOKEN.findall(text)}
+
+
+def _postings(token: str) -> str:
+    return f"imap:tok:{token}"
+
+
+def _coverage(token: str) -> str:
+    return f"imap:tokcov:{token}"
+
+
+def _state(uidvalidity: int, uidnext: int) -> str:
+    return f"{uidvalidity}:{uidnext}"
+
+
+def add(folder: str, uidvalidity: int, results: Iterable, tokens: Iterable = ()):
+    """Добавить письма в списки найденных в них ИНН/ОГРН и в списки tokens"""
+    if not available() or not uidvalidity:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for result in results:
+            member = f"{folder}:{uidvalidity}:{result.id.decode()}"
+            score = result.date.timestamp() if result.date else 0
+            for token in extract(result) | set(tokens):
+                pipe.zadd(_postings(token), {member: score})
+                pipe.expire(_postings(token), app.config.REDIS.EXPIRATION_SECONDS)
+        pipe.execute()
+    except redis.RedisError as ex:
+        logger.warning(f"{ex}")
+
+
+def cover(token: str, folder: str, uidvalidity: int, uidnext: int):
+    """Отметить список писем token в папке полным на момент uidnext"""
+    if not available() or not uidvalidity or not uidnext:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(_coverage(token), folder, _state(uidvalidity, uidnext))
+        pipe.expire(_coverage(token), app.config.REDIS.EXPIRATION_SECONDS)
+        pipe.execute()
+    except redis.RedisError as ex:
+        logger.warning(f"{ex}")
+
+
+def lookup(
+    tokens: List[str],
+    folder: str,
+    uidvalidity: int,
+    uidnext: int,
+    since: datetime.datetime,
+) -> Optional[List[bytes]]:
+    """UID писем папки, содержащих любой из tokens и отправленных не ранее since.
+    None - если список какого-либо из tokens не полон"""
+    if not available() or not tokens:
+        return None
+    prefix = f"{folder}:{uidvalidity}:"
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for token in tokens:
+            pipe.hget(_coverage(token), folder)
+        for token in tokens:
+            pipe.zrangebyscore(_postings(token), since.timestamp(), "+inf")
+        data = pipe.execute()
+    except redis.RedisError as ex:
+        logger.warning(f"{ex}")
+        return None
+    state = _state(uidvalidity, uidnext).encode()
+    if any(x != state for x in data[: len(tokens)]):
+        return None
+    uids = {
+        int(member[len(prefix) :])
+        for members in data[len(tokens) :]
+        for member in (x.decode() for x in members)
+        if member.startswith(prefix)
+    }
+    return [str(x).encode() for x in sorted(uids)]
@@ -0,0 +1,61 @@
+"""Индекс (папка, UIDVALIDITY, UID) писем в Redis.
+UID уникален только внутри папки, индекс позволяет выбирать письмо
+по идентификатору сразу из нужных папок без перебора всех папок.
+Для каждой папки запоминается, есть ли в ней письмо с этим UID: письмо
+встречалось в списке писем или не найдено при выборке (только для UID
+меньше UIDNEXT папки - такой UID в папке уже не появится). Перебор
+сокращается, только если по индексу известна каждая папка запроса;
+точную папку задает параметр path=!<папка> (ссылки списка писем содержат его)"""
+import logging
+import redis
+from typing import Dict, Iterable
+from src import app
+from src.redis_cache import redis_client, available
+
+logger = logging.getLogger(__name__)
+
+
+def _key(id: bytes) -> str:
+    return f"imap:uid:{id.decode()}"
+
+
+def remember(folder: str, uidvalidity: int, ids: Iterable[bytes], found: bool = True):
+    """Запомнить, что письма с идентификаторами ids есть (found) или
+    отсутствуют в папке"""
+    if not available() or not uidvalidity:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for id in ids:
+            pipe.hset(_key(id), folder, uidvalidity if found else -uidvalidity)
+            pipe.expire(_key(id), app.config.REDIS.EXPIRATION_SECONDS)
+        pipe.execute()
+    except redis.RedisError as ex:
+        logger.warning(f"{ex}")
+
+
+def lookup(id: bytes, folders: Iterable[str]) -> Dict[str, tuple]:
+    """Известные по индексу папки из folders: {папка: (uidvalidity, есть
+    ли в ней письмо id)}"""
+    if not available():
+        return {}
+    try:
+        data = redis_client.hgetall(_key(id))
+    except redis.RedisError as ex:
+        logger.warning(f"{ex}")
+        return {}
+    found = {k.decode(): int(v) for k, v in data.items()}
+    return {
+        folder: (abs(found[folder]), found[folder] > 0)
+        for folder in folders
+        if folder in found
+    }
+
+
+def forget(id: bytes, folder: str):
+    if not available():
+        return
+    try:
+        redis_client.hdel(_key(id), folder)
+    except redis.RedisError as ex:
+        logger.warning(f"{ex}")